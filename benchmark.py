@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# Benchmarks for Nimbler's hot paths: refreshing the window list, ranking it
+# while typing, fuzzy scoring and populating the popup.
+#
+# Windows and workspaces are faked so the numbers don't depend on whatever
+# happens to be open. Populating the popup needs a display, but any display
+# will do, so this runs fine headless:
+#
+#   xvfb-run -a python3 benchmark.py --windows 10,100,1000 --workspaces 1,8,32
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import nimbler
+from nimbler import Gdk, GdkPixbuf
+
+
+APPLICATIONS = ['Terminal', 'Firefox', 'Gimp', 'Thunderbird', 'Geany', 'Nautilus', 'LibreOffice', 'Vim']
+
+# Typed one character at a time, like a user would
+QUERIES = {
+    'short': 'term',
+    'long': 'nimbpy',
+    'unicode': 'résumé',
+}
+
+
+def make_source(window_count, workspace_count, titles='short', pids=False):
+    # Every window gets the same icon; it's the pixbuf handling that's measured, not its content.
+    # soak.py uses these too.
+    icon = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, 32, 32)
+    source = nimbler.ReplayWindowSource(workspace_count, icon)
+    for i in range(window_count):
+        open_window(source, i, titles, pids)
+    source.activate_window(source.windows[0] if source.windows else None)
+
+    return source
+
+
+def open_window(source, i, titles='short', pids=False):
+    application = APPLICATIONS[i % len(APPLICATIONS)]
+    # Never our own pid, the popup would filter it out while it's open
+    return source.open_window(make_title(titles, application, i), application,
+        i % source.get_workspace_count(), pid=i + 1 if pids else 0)
+
+
+def make_churn(window_count, workspace_count, titles, event_count):
+    # Opens, closes, renames, moves and focus changes in roughly the
+    # proportions of a busy session with lots of terminals and browser tabs
+    random.seed(window_count)
+    events = [{'event': 'workspaces', 'count': workspace_count}]
+    windows = []
+    for i in range(window_count):
+        application = APPLICATIONS[i % len(APPLICATIONS)]
+        events.append({'event': 'open', 'id': i, 'name': make_title(titles, application, i),
+            'class_group': application, 'workspace': i % workspace_count})
+        windows.append(i)
+
+    next_id = window_count
+    while len(events) < event_count:
+        choice = random.random()
+        if choice < 0.5 and windows:
+            i = random.choice(windows)
+            events.append({'event': 'rename', 'id': i,
+                'name': make_title(titles, APPLICATIONS[i % len(APPLICATIONS)], len(events))})
+        elif choice < 0.7 and windows:
+            events.append({'event': 'activate', 'id': random.choice(windows)})
+        elif choice < 0.8 and windows:
+            events.append({'event': 'move', 'id': random.choice(windows),
+                'workspace': random.randrange(workspace_count)})
+        elif choice < 0.9 and len(windows) > 1:
+            i = windows.pop(random.randrange(len(windows)))
+            events.append({'event': 'close', 'id': i})
+        else:
+            application = APPLICATIONS[next_id % len(APPLICATIONS)]
+            events.append({'event': 'open', 'id': next_id, 'name': make_title(titles, application, next_id),
+                'class_group': application, 'workspace': random.randrange(workspace_count)})
+            windows.append(next_id)
+            next_id += 1
+
+    return events
+
+
+def make_title(titles, application, i):
+    if titles == 'short':
+        return '%s %d' % (application, i)
+    elif titles == 'long':
+        return '%s - ~/src/project-%d/nimbler/nimbler.py (some/rather/deep/path/%d) - %s %s' % (
+            'user@host', i, i * 7, application, 'x' * (i % 40))
+    elif titles == 'unicode':
+        return '%s — résumé №%d 日本語のタイトル 😀 Ünïcödé %s' % (application, i, 'é' * (i % 20))
+
+
+def measure(function, repeat, setup=None):
+    # Whatever setup returns is passed to function and isn't timed
+    def arguments():
+        if setup is None:
+            return ()
+        return (setup(),)
+
+    timings = []
+    for i in range(repeat):
+        args = arguments()
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+
+    # Separate run, tracing allocations slows everything down
+    args = arguments()
+    tracemalloc.start()
+    function(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    blocks = len(tracemalloc.take_snapshot().traces)
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'median_ms': timings[len(timings) // 2] * 1000,
+        'max_ms': timings[-1] * 1000,
+        'peak_kib': peak / 1024.0,
+        'live_blocks': blocks,
+    }
+
+
+def benchmark_model(config, window_count, workspace_count, titles, repeat):
+    results = []
+    source = make_source(window_count, workspace_count, titles)
+
+    def window_list(live=False):
+        windows = nimbler.WindowList(
+            config.ignored_windows,
+            config.always_show_windows,
+            config.ignored_window_types,
+            config.icon_size,
+            source
+        )
+        if live:
+            windows.watch()
+        return windows
+
+    windows = window_list()
+    results.append(('refresh', measure(windows.refresh, repeat)))
+
+    live_windows = window_list(True)
+    results.append(('refresh (live)', measure(live_windows.refresh, repeat)))
+
+    def rename():
+        # One title change, then refresh like opening the popup would
+        window = source.windows[0]
+        source.rename_window(window, window.name + '!')
+        live_windows.refresh()
+    results.append(('rename + refresh (live)', measure(rename, repeat)))
+
+    query = QUERIES[titles]
+
+    def typing():
+        windows.reset_rank()
+        for i in range(1, len(query) + 1):
+            windows.rank(query[:i])
+    results.append(('rank (typing "%s")' % query, measure(typing, repeat)))
+
+    def typing_cold():
+        windows.fuzzyMatcher = nimbler.FuzzyMatcher()
+        typing()
+    results.append(('rank (typing, cold cache)', measure(typing_cold, repeat)))
+
+    names = [window.get_name() for window in source.windows]
+
+    def score():
+        matcher = nimbler.FuzzyMatcher()
+        matcher.setPattern(query)
+        for name in names:
+            matcher.score(name)
+    results.append(('FuzzyMatcher.score (cold)', measure(score, repeat)))
+
+    return results
+
+
+def benchmark_churn(config, events, repeat):
+    # How fast the live model keeps up with a stream of window events
+    icon = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, 32, 32)
+
+    def watched():
+        source = nimbler.ReplayWindowSource(1, icon)
+        windows = nimbler.WindowList(
+            config.ignored_windows,
+            config.always_show_windows,
+            config.ignored_window_types,
+            config.icon_size,
+            source
+        )
+        windows.watch()
+        return source, windows
+
+    def replay(watched):
+        source, windows = watched
+        source.replay(events)
+        windows.refresh()
+
+    result = measure(replay, repeat, watched)
+    result['events_per_s'] = len(events) / (result['median_ms'] / 1000.0)
+
+    return [('replay %d events (live)' % len(events), result)]
+
+
+def benchmark_popup(config, window_count, workspace_count, titles, repeat):
+    results = []
+    source = make_source(window_count, workspace_count, titles)
+    popups = []
+
+    def popup():
+        win = nimbler.NimblerWindow(config, source)
+        popups.append(win)
+        return win
+
+    def populate_cold(win):
+        win.populate(win.windowList.get())
+    results.append(('populate (cold)', measure(populate_cold, repeat, popup)))
+
+    win = popup()
+    win.populate(win.windowList.get())
+
+    def populate_warm():
+        win.populate(win.windowList.get())
+    results.append(('populate (unchanged)', measure(populate_warm, repeat)))
+
+    def populate_changed():
+        # Rename a tenth of the windows
+        for window in source.windows[::10]:
+            source.rename_window(window, window.name[::-1])
+        win.windowList.refresh()
+        win.populate(win.windowList.get())
+    results.append(('populate (10% renamed)', measure(populate_changed, repeat)))
+
+    for popup_window in popups:
+        popup_window.windowList.unwatch()
+        popup_window.destroy()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Nimbler against synthetic window sets.')
+    parser.add_argument('--windows', default='10,100,1000', help='comma separated window counts')
+    parser.add_argument('--workspaces', default='1,8,32', help='comma separated workspace counts')
+    parser.add_argument('--titles', default='short,long,unicode', help='comma separated title kinds: short, long, unicode')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement')
+    parser.add_argument('--no-popup', action='store_true', help='skip the benchmarks that need a display')
+    parser.add_argument('--churn', type=int, default=10000, help='number of synthetic window events to replay')
+    parser.add_argument('--replay', metavar='TRACE', help='replay a trace recorded with nimbler.py --record-trace instead')
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    args = parser.parse_args()
+
+    # Defaults only, your own configuration shouldn't skew the numbers
+    config = nimbler.Config([])
+    config.live_window_list = True
+
+    popup = not args.no_popup
+    if popup and Gdk.Display.get_default() is None:
+        print('No display, skipping popup benchmarks (try xvfb-run)', file=sys.stderr)
+        popup = False
+
+    if not args.json:
+        print('%-34s %7s %5s %-8s %10s %10s %10s %8s' % (
+            'phase', 'windows', 'ws', 'titles', 'median ms', 'max ms', 'peak KiB', 'blocks'))
+
+    for window_count in [int(i) for i in args.windows.split(',')]:
+        for workspace_count in [int(i) for i in args.workspaces.split(',')]:
+            for titles in args.titles.split(','):
+                results = benchmark_model(config, window_count, workspace_count, titles, args.repeat)
+                if args.replay:
+                    events = nimbler.load_trace(args.replay)
+                else:
+                    events = make_churn(window_count, workspace_count, titles, args.churn)
+                results += benchmark_churn(config, events, args.repeat)
+                if popup:
+                    results += benchmark_popup(config, window_count, workspace_count, titles, args.repeat)
+
+                for phase, result in results:
+                    if 'events_per_s' in result:
+                        phase += ', %d/s' % result['events_per_s']
+                    if args.json:
+                        result.update({
+                            'phase': phase,
+                            'windows': window_count,
+                            'workspaces': workspace_count,
+                            'titles': titles,
+                        })
+                        print(json.dumps(result))
+                    else:
+                        print('%-34s %7d %5d %-8s %10.3f %10.3f %10.1f %8d' % (
+                            phase, window_count, workspace_count, titles,
+                            result['median_ms'], result['max_ms'], result['peak_kib'], result['live_blocks']))
+
+if __name__ == '__main__':
+    main()
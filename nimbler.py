@@ -1,11 +1,124 @@
 #!/usr/bin/env python3
+import os
+import socket
+import sys
+import time
+
+# As early as possible, for the startup report
+STARTED = time.time()
+
+# Commands for a running daemon. These are handled before anything else is
+# imported so that binding one of them to a key costs next to nothing.
+CLIENT_COMMANDS = {
+    '--show': 'show',
+    '--hide': 'hide',
+    '--toggle': 'toggle',
+    '--quit': 'quit',
+    '--startup-report': 'startup',
+    '--stats': 'stats',
+}
+
+# Seconds to wait for the daemon, as long as it waits for a client
+CLIENT_TIMEOUT = 1.0
+
+def get_socket_path():
+    directory = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+    # One daemon per user and display
+    display = os.environ.get('DISPLAY', '').replace('/', '_')
+    return os.path.join(directory, 'nimbler-%d%s.sock' % (os.getuid(), display))
+
+def send_command(command):
+    # Returns the daemon's reply, or None if there's no daemon to talk to.
+    # Raises socket.timeout if there is one, but it doesn't answer.
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # A stuck daemon mustn't leave every key press waiting on it
+    client.settimeout(CLIENT_TIMEOUT)
+    try:
+        client.connect(get_socket_path())
+        client.sendall((command + '\n').encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+
+        reply = []
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            reply.append(data)
+    except socket.timeout:
+        raise
+    except socket.error:
+        return None
+    finally:
+        client.close()
+
+    return b''.join(reply).decode('utf-8')
+
+def client_main(command):
+    try:
+        reply = send_command(command)
+    except socket.timeout:
+        sys.stderr.write('Nimbler is not responding\n')
+        return 1
+    if reply is None:
+        sys.stderr.write('Nimbler is not running, start it with --daemon\n')
+        return 1
+
+    sys.stdout.write(reply)
+    return 0
+
+def get_query_command(arguments):
+    # --list, --list --json and --activate QUERY as a daemon command
+    if arguments in (['--list'], ['--list', '--json'], ['--json', '--list']):
+        return 'list-json' if '--json' in arguments else 'list'
+    if len(arguments) == 2 and arguments[0] == '--activate':
+        return get_activate_command(arguments[1])
+
+    return None
+
+def get_activate_command(query):
+    # One line per command, None if there's nothing to look for
+    query = ' '.join(query.split())
+    if not query:
+        return None
+
+    return 'activate ' + query
+
+def query_client_main(command):
+    # Returns None if there's no daemon to ask
+    try:
+        reply = send_command(command)
+    except socket.timeout:
+        # It may still get to the command, so not again without it
+        sys.stderr.write('Nimbler is not responding\n')
+        return 1
+    if reply is None:
+        return None
+
+    sys.stdout.write(reply)
+    # Nothing to activate
+    if command.startswith('activate ') and not reply:
+        return 1
+
+    return 0
+
+if __name__ == '__main__' and len(sys.argv) == 2 and sys.argv[1] in CLIENT_COMMANDS:
+    sys.exit(client_main(CLIENT_COMMANDS[sys.argv[1]]))
+
+# Without a daemon these go on below, but without the popup
+early_query_command = None
+if __name__ == '__main__':
+    early_query_command = get_query_command(sys.argv[1:])
+    if early_query_command is not None:
+        status = query_client_main(early_query_command)
+        if status is not None:
+            sys.exit(status)
+
 import gi
 gi.require_version('GdkX11', '3.0')
 gi.require_version('Gtk', '3.0')
-gi.require_version('Keybinder', '3.0')
 gi.require_version('Wnck', '3.0')
 
-from gi.repository import Gtk, GdkPixbuf, Wnck, Keybinder, Gdk, GdkX11, Pango
+from gi.repository import Gtk, GdkPixbuf, Wnck, Gdk, GdkX11, GLib, Gio, Pango
 import re
 
 # First try Python 3 configparser
@@ -14,9 +127,13 @@ try:
 # Then try ConfigParser for Python 2 compatibility
 except ImportError:
     import ConfigParser as configparser
-import os
+import argparse
+import itertools
+import json
+import math
 import signal
 import string
+from collections import OrderedDict, deque
 from xml.sax.saxutils import escape
 
 # Python GObject Introspection API Reference available at http://lazka.github.io/pgi-docs/
@@ -25,142 +142,1966 @@ from xml.sax.saxutils import escape
 
 # Libwnck reference here: https://developer.gnome.org/libwnck/stable/
 
+IMPORTED = time.time()
+
+def lowercase(string):
+    # Lowercase without changing the length, so columns still line up
+    lower = string.lower()
+    # A few characters turn into more than one when lowercased
+    if len(lower) != len(string):
+        lower = ''.join([c.lower()[:1] for c in string])
+
+    return lower
+
+
 class FuzzyMatcher():
 
-    def __init__(self):
+    # Scoring along the lines of fzf: every matched character is worth the
+    # same, gaps cost a little and matches at the start of a word, on a
+    # camelCase hump or right after the previous match earn a bonus
+    SCORE_MATCH = 16
+    SCORE_GAP_START = -3
+    SCORE_GAP_EXTENSION = -1
+    BONUS_BOUNDARY = SCORE_MATCH // 2
+    BONUS_NON_WORD = SCORE_MATCH // 2
+    BONUS_CAMEL = BONUS_BOUNDARY + SCORE_GAP_EXTENSION
+    BONUS_CONSECUTIVE = -(SCORE_GAP_START + SCORE_GAP_EXTENSION)
+    BONUS_FIRST_CHAR_MULTIPLIER = 2
+
+    def __init__(self, cache_size=4096):
         self.pattern = ''
+        self.cache_size = cache_size
+        # Lowercase and bonus tables per string, they only depend on the string
+        self.candidates = {}
+        # Results per (pattern, string) so retyping the same query is free
+        self.results = {}
 
     def setPattern(self, pattern):
-        self.pattern = re.compile('.*?'.join(map(re.escape, list(pattern))))
+        self.pattern = pattern.lower()
 
     def score(self, string):
-        match = self.pattern.search(string)
+        match = self.match(string)
         if match is None:
             return 0
         else:
-            return 100.0 * (1.0/(1 + match.start()) + 1.2/(match.end() - match.start() + 1))
+            return match[0]
+
+    def match(self, string):
+        key = (self.pattern, string)
+        if key in self.results:
+            return self.results[key]
+
+        result = self.align(self.pattern, string)
+        self.remember(self.results, key, result)
+
+        return result
+
+    def remember(self, cache, key, value):
+        # Forget the oldest entries once the cache is full
+        if len(cache) >= self.cache_size:
+            for old_key in list(cache)[:self.cache_size // 4]:
+                del cache[old_key]
+        cache[key] = value
+
+    def prepare(self, string):
+        if string in self.candidates:
+            return self.candidates[string]
+
+        lower = lowercase(string)
+
+        bonus = []
+        previous = None
+        for c in string:
+            if not c.isalnum():
+                bonus.append(self.BONUS_NON_WORD)
+            elif previous is None or not previous.isalnum():
+                bonus.append(self.BONUS_BOUNDARY)
+            elif previous.islower() and c.isupper():
+                bonus.append(self.BONUS_CAMEL)
+            elif c.isdigit() and not previous.isdigit():
+                bonus.append(self.BONUS_CAMEL)
+            else:
+                bonus.append(0)
+            previous = c
+
+        prepared = (lower, bonus)
+        self.remember(self.candidates, string, prepared)
+
+        return prepared
+
+    def align(self, pattern, string):
+        if not pattern or not string:
+            return None
+
+        lower, bonus = self.prepare(string)
+        m = len(pattern)
+
+        # Cheap subsequence check first. It also gives the first and last
+        # column where each pattern character can possibly be matched.
+        first = []
+        j = -1
+        for c in pattern:
+            j = lower.find(c, j + 1)
+            if j < 0:
+                return None
+            first.append(j)
+
+        last = [0] * m
+        j = len(lower)
+        for i in range(m - 1, -1, -1):
+            j = lower.rfind(pattern[i], 0, j)
+            last[i] = j
+
+        # Score of the best alignment with pattern[i] matched in column j,
+        # the bonus of the run it's part of and where pattern[i - 1] went
+        scores = {}
+        runs = {}
+        previous_columns = [None] * m
+
+        c = pattern[0]
+        for j in range(first[0], last[0] + 1):
+            if lower[j] == c:
+                scores[j] = self.SCORE_MATCH + bonus[j] * self.BONUS_FIRST_CHAR_MULTIPLIER
+                runs[j] = bonus[j]
+
+        for i in range(1, m):
+            c = pattern[i]
+            previous_scores = scores
+            previous_runs = runs
+            scores = {}
+            runs = {}
+            columns = {}
+
+            # Best score of a match in an earlier column followed by a gap
+            gap_score = None
+            gap_column = None
+            for j in range(first[i - 1] + 1, last[i] + 1):
+                if gap_score is not None:
+                    gap_score += self.SCORE_GAP_EXTENSION
+                k = j - 2
+                if k in previous_scores:
+                    score = previous_scores[k] + self.SCORE_GAP_START
+                    if gap_score is None or score > gap_score:
+                        gap_score = score
+                        gap_column = k
+
+                if j < first[i] or lower[j] != c:
+                    continue
+
+                best = None
+                if gap_score is not None:
+                    best = gap_score + self.SCORE_MATCH + bonus[j]
+                    runs[j] = bonus[j]
+                    columns[j] = gap_column
+
+                if j - 1 in previous_scores:
+                    run = max(previous_runs[j - 1], bonus[j], self.BONUS_CONSECUTIVE)
+                    score = previous_scores[j - 1] + self.SCORE_MATCH + run
+                    if best is None or score >= best:
+                        best = score
+                        runs[j] = run
+                        columns[j] = j - 1
+
+                if best is not None:
+                    scores[j] = best
+
+            if not scores:
+                return None
+            previous_columns[i] = columns
+
+        # Walk back from the best final column to find the matched positions
+        j = max(scores, key=lambda x: (scores[x], -x))
+        score = scores[j]
+        positions = [j]
+        for i in range(m - 1, 0, -1):
+            j = previous_columns[i][j]
+            positions.append(j)
+        positions.reverse()
+
+        # Long gaps can push the score down, but a match is still a match
+        return (max(score, 1), positions)
+
+class CharacterIndex():
+
+    # Which windows contain which characters. A fuzzy match needs every
+    # character of the query somewhere in the title or the class, so windows
+    # missing one of them can be skipped without scoring them.
 
-class KeyBindings():
-    
     def __init__(self):
-        # That's 93 distinct characters on my system
-        # Can't use string.printable because that includes string.whitespace
-        self.numbering = string.digits + string.ascii_letters + string.punctuation.replace(':', '') # filter colon
-        self.numbering = list(self.numbering)
-        self.function_keys = ['F1', 'F2', 'F3', 'F4', 'F5', 'F6', 'F7', 'F8', 'F9', 'F10', 'F11', 'F12']
-        
-    def get_keyvals_from_unicode(self):
-        self.keyvals_from_unicode = []
-        
-        for number in self.numbering:
-            unicode_character = ord(number)
-            keyval = Gdk.unicode_to_keyval(unicode_character)
-            self.keyvals_from_unicode.append(keyval)
+        self.grams = {}
+        self.keys = {}
+
+    def get_grams(self, value):
+        # Both ways, the query is lowercased as a whole
+        grams = set(value.lower())
+        grams.update(lowercase(value))
+        return grams
+
+    def get_query_grams(self, text):
+        return set(text)
+
+    def update(self, key, *values):
+        grams = set()
+        for value in values:
+            if value:
+                grams.update(self.get_grams(value))
+
+        previous = self.keys.get(key, set())
+        if grams == previous:
+            return
+        self.keys[key] = grams
 
-        return self.keyvals_from_unicode
-        
-    def get_keyvals_from_name(self):
-        self.keyvals_from_name = []
-        
-        for function_key in self.function_keys:
-            keyval = Gdk.keyval_from_name(function_key)
-            self.keyvals_from_name.append(keyval)
+        for gram in previous - grams:
+            keys = self.grams[gram]
+            keys.discard(key)
+            if not keys:
+                del self.grams[gram]
+        for gram in grams - previous:
+            self.grams.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        for gram in self.keys.pop(key, ()):
+            keys = self.grams[gram]
+            keys.discard(key)
+            if not keys:
+                del self.grams[gram]
+
+    def clear(self):
+        self.grams = {}
+        self.keys = {}
 
-        return self.keyvals_from_name
+    def lookup(self, text):
+        # The keys that may contain text, None for no text
+        sets = []
+        for gram in self.get_query_grams(text):
+            keys = self.grams.get(gram)
+            if keys is None:
+                return set()
+            sets.append(keys)
+
+        if not sets:
+            return None
+
+        # Starting from the rarest keeps the intersections small
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+
+class SubstringIndex(CharacterIndex):
+
+    # Which strings contain which substrings of up to LENGTH characters, for
+    # process text that has to contain the query as is. Command lines cover
+    # most of the alphabet, their trigrams don't. Exact for queries up to
+    # LENGTH long, longer ones need all their trigrams.
+
+    LENGTH = 3
+
+    def get_grams(self, value):
+        grams = set()
+        for length in range(1, self.LENGTH + 1):
+            grams.update([value[i:i + length] for i in range(len(value) - length + 1)])
+        return grams
+
+    def get_query_grams(self, text):
+        if len(text) <= self.LENGTH:
+            return set([text]) if text else set()
+
+        return set([text[i:i + self.LENGTH] for i in range(len(text) - self.LENGTH + 1)])
+
+
+class KeyBindings():
+
+    # Turns key presses into actions with a single lookup each. Window
+    # shortcuts can be several keys long, so the dispatch table is a trie: a
+    # key leads either to an action or to the table for the next key.
+
+    # Shift is part of the character typed and lock keys don't matter
+    MODIFIERS = Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.MOD1_MASK | Gdk.ModifierType.SUPER_MASK
+
+    # Actions and the number of arguments they take
+    ACTIONS = {
+        'hide': 0,
+        'search': 0,
+        'activate': 0,
+        'close': 0,
+        'workspace': 1,
+        'window': 1,
+        'close_window': 1,
+        'none': 0,
+    }
+
+    DEFAULT_BINDINGS = [
+        'Escape hide',
+        'colon search',
+        'Return activate',
+        'KP_Enter activate',
+        '<Control>Return close',
+        '<Control>KP_Enter close',
+    ] + ['F%d workspace %d' % (i, i) for i in range(1, 13)]
+
+    def __init__(self, characters=None, bindings=()):
+        self.bindings = {}
+        for binding in self.DEFAULT_BINDINGS + list(bindings):
+            key, action = self.parse_binding(binding)
+            if action == ('none',):
+                self.bindings.pop(key, None)
+            else:
+                self.bindings[key] = action
+
+        # While typing a search, only keys that don't type anything do something
+        self.typing_bindings = dict([(key, action) for key, action in self.bindings.items()
+            if key[1] or not self.is_printable(key[0])])
+
+        # That's 93 distinct characters on my system, minus the ones bound to something else
+        # Can't use string.printable because that includes string.whitespace
+        if characters is None:
+            characters = string.digits + string.ascii_letters + string.punctuation
+        self.keyvals = OrderedDict()
+        for character in characters:
+            keyval = Gdk.unicode_to_keyval(ord(character))
+            if (keyval, 0) not in self.bindings:
+                self.keyvals.setdefault(character, keyval)
+        self.numbering = list(self.keyvals)
+        # A single one can't be combined into longer shortcuts
+        if len(self.numbering) < 2:
+            raise ValueError('At least two characters are needed for window shortcuts')
+
+        # The keypad's digits work like the regular ones
+        self.keypad = dict([(Gdk.keyval_from_name(str(i)), Gdk.keyval_from_name('KP_%d' % i)) for i in range(10)])
+
+        self.dispatch = None
+        self.dispatch_size = None
+
+    def is_printable(self, keyval):
+        # Escape, Return and Tab have a character too, but they don't type it
+        character = Gdk.keyval_to_unicode(keyval)
+        return bool(character) and chr(character).isprintable()
+
+    def parse_binding(self, binding):
+        # Like "<Control>g hide" or "F3 workspace 3"
+        fields = binding.split()
+        if len(fields) < 2 or fields[1] not in self.ACTIONS or len(fields) - 2 != self.ACTIONS[fields[1]]:
+            raise ValueError('Invalid key binding: %s' % binding)
+
+        keyval, modifiers = Gtk.accelerator_parse(fields[0])
+        if not keyval:
+            raise ValueError('Invalid key in key binding: %s' % binding)
+
+        # Numbered from 1 like the workspace buttons
+        arguments = [int(argument) - 1 for argument in fields[2:]]
+
+        return (keyval, int(modifiers & self.MODIFIERS)), tuple([fields[1]] + arguments)
+
+    def get_shortcuts(self, count):
+        # One character each as long as there are enough of them, otherwise
+        # sequences of the same length so that none is a prefix of another
+        length = 1
+        while len(self.numbering) ** length < count:
+            length += 1
+
+        shortcuts = []
+        for shortcut in itertools.product(self.numbering, repeat=length):
+            if len(shortcuts) == count:
+                break
+            shortcuts.append(''.join(shortcut))
+
+        return shortcuts
+
+    def get_dispatch(self, shortcuts, workspace_count):
+        # Only depends on how many windows and workspaces there are
+        size = (len(shortcuts), workspace_count)
+        if size == self.dispatch_size:
+            return self.dispatch
+
+        limits = {'workspace': workspace_count, 'window': len(shortcuts), 'close_window': len(shortcuts)}
+        dispatch = {}
+        for key, action in self.bindings.items():
+            if action[0] in limits and action[1] >= limits[action[0]]:
+                continue
+            dispatch[key] = action
+
+        for number, shortcut in enumerate(shortcuts):
+            self.add_shortcut(dispatch, shortcut, number)
+
+        self.dispatch = dispatch
+        self.dispatch_size = size
+        return dispatch
+
+    def add_shortcut(self, table, shortcut, number):
+        keyval = self.keyvals[shortcut[0]]
+        keyvals = [keyval]
+        if keyval in self.keypad:
+            keyvals.append(self.keypad[keyval])
+        control = int(Gdk.ModifierType.CONTROL_MASK)
+
+        # Bindings of your own come first, e.g. <Control>q over closing window q
+        if len(shortcut) == 1:
+            for keyval in keyvals:
+                table.setdefault((keyval, 0), ('window', number))
+                table.setdefault((keyval, control), ('close_window', number))
+            return
+
+        # Holding Control for the whole sequence is fine too
+        following = table.get((keyval, 0))
+        if not isinstance(following, dict):
+            following = {}
+        for keyval in keyvals:
+            table.setdefault((keyval, 0), following)
+            table.setdefault((keyval, control), following)
+        self.add_shortcut(following, shortcut[1:], number)
 
 class DPIScaling():
 
-    def __init__(self):
+    def __init__(self, monitor=None):
         # Get the screen dpi
         self.dpi = Gdk.Screen.get_resolution(Gdk.Screen.get_default())
         # This is a scale factor between points specified in a Pango.FontDescription and cairo units. The default value is 96, meaning that a 10 point font will be 13 units high. (10 * 96. / 72. = 13.3).
         # See http://lazka.github.io/pgi-docs/#Gdk-3.0/classes/Screen.html#Gdk.Screen.set_resolution
         self.scaling_factor = self.dpi / 96
+        # Device pixels per pixel on the monitor. GTK scales the widgets by
+        # itself, but icons have to be made that much larger to stay sharp.
+        self.monitor_scale = monitor.get_scale_factor() if monitor is not None else 1
+
+class LatencySpan():
+
+    def __init__(self, latency, phase):
+        self.latency = latency
+        self.phase = phase
+        self.cycle = latency.cycle
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        # The cycle may have ended in the meantime
+        if self.latency.cycle is self.cycle:
+            self.latency.add(self.phase, time.perf_counter() - self.start)
+
+
+class NullSpan():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class Latency():
+
+    # Where the time goes between pressing the hotkey and the popup showing
+    # up. A cycle starts when the popup is asked to open and ends once it's
+    # been drawn and has focus. Spans and counters only count during a cycle,
+    # what the live window list does in between isn't anyone's wait.
+
+    NULL_SPAN = NullSpan()
+
+    def __init__(self, history=1000):
+        self.cycles = deque(maxlen=history)
+        self.cycle = None
+        self.cycle_count = 0
+        self.start = None
+        # JSON lines, one per cycle
+        self.log = None
+        # cProfile and, optionally, tracemalloc dumps per cycle
+        self.profile_dir = None
+        self.profile_memory = False
+        self.profiler = None
+
+    def begin(self, trigger):
+        if self.cycle is not None:
+            return
+
+        self.cycle_count += 1
+        self.cycle = {
+            'cycle': self.cycle_count,
+            'trigger': trigger,
+            'time': time.time(),
+            'phases': {},
+            'counters': {},
+        }
+        self.start = time.perf_counter()
+
+        if self.profile_dir is not None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def span(self, phase):
+        # Time spent in the with block, added up per phase
+        if self.cycle is None:
+            return self.NULL_SPAN
+
+        return LatencySpan(self, phase)
+
+    def add(self, phase, duration):
+        phases = self.cycle['phases']
+        phases[phase] = phases.get(phase, 0) + duration
+
+    def count(self, counter, amount=1):
+        if self.cycle is not None:
+            counters = self.cycle['counters']
+            counters[counter] = counters.get(counter, 0) + amount
+
+    def mark(self, phase):
+        # Time from the start of the cycle, only the first time around
+        if self.cycle is None or phase in self.cycle['phases']:
+            return
+
+        self.cycle['phases'][phase] = time.perf_counter() - self.start
+        if 'first_draw' in self.cycle['phases'] and 'focus' in self.cycle['phases']:
+            self.finish()
+
+    def finish(self):
+        if self.cycle is None:
+            return
+
+        cycle = self.cycle
+        self.cycle = None
+        cycle['total'] = time.perf_counter() - self.start
+        for phase in cycle['phases']:
+            cycle['phases'][phase] *= 1000
+        cycle['total'] *= 1000
+        self.cycles.append(cycle)
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(self.profile_dir, 'cycle-%d.prof' % cycle['cycle']))
+            self.profiler = None
+        if self.profile_memory:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                tracemalloc.take_snapshot().dump(os.path.join(self.profile_dir, 'cycle-%d.tracemalloc' % cycle['cycle']))
+
+        if self.log is not None:
+            self.log.write(json.dumps(cycle) + '\n')
+            self.log.flush()
+
+    def get_percentile(self, values, percentile):
+        # Nearest rank, values are sorted
+        return values[max(int(math.ceil(percentile / 100.0 * len(values))) - 1, 0)]
+
+    def stats(self):
+        # Percentiles per phase over the cycles kept around, in milliseconds
+        phases = {}
+        counters = {}
+        for cycle in self.cycles:
+            phases.setdefault('total', []).append(cycle['total'])
+            for phase, duration in cycle['phases'].items():
+                phases.setdefault(phase, []).append(duration)
+            for counter, amount in cycle['counters'].items():
+                counters.setdefault(counter, []).append(amount)
+
+        report = {'cycles': len(self.cycles), 'phases': {}, 'counters': {}}
+        for phase, durations in phases.items():
+            durations.sort()
+            report['phases'][phase] = {
+                'count': len(durations),
+                'p50': self.get_percentile(durations, 50),
+                'p90': self.get_percentile(durations, 90),
+                'p99': self.get_percentile(durations, 99),
+                'max': durations[-1],
+            }
+        for counter, amounts in counters.items():
+            report['counters'][counter] = {
+                'mean': sum(amounts) / float(len(self.cycles)),
+                'max': max(amounts),
+            }
+
+        return report
+
+    def format(self):
+        return json.dumps(self.stats(), sort_keys=True) + '\n'
+
+latency = Latency()
+
+
+class PixbufCache():
+
+    # Values by key, each with a pixbuf that counts towards max_bytes. Once
+    # they take up more than that the least recently used ones go, but the
+    # newest one always stays.
+
+    def __init__(self, max_bytes, on_evicted=None):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+        # Called with the key of whatever had to make room
+        self.on_evicted = on_evicted
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        # Counts as a use
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def peek(self, key):
+        return self.entries[key][0]
+
+    def store(self, key, value, pixbuf):
+        self.discard(key)
+        size = pixbuf.get_rowstride() * pixbuf.get_height() if pixbuf is not None else 0
+        self.entries[key] = (value, size)
+        self.bytes += size
+
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            evicted = next(iter(self.entries))
+            self.discard(evicted)
+            if self.on_evicted is not None:
+                self.on_evicted(evicted)
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+
+class IconCache():
+
+    # Icons are shared by all windows of an application, unless a window
+    # changes its icon to a different one. They're stored scaled to the size
+    # they'll be shown at, in a PixbufCache.
+
+    SIZES = {'default': 32, 'mini': 16}
+
+    def __init__(self, icon_size, scaling_factor=1, max_bytes=4 * 1024 * 1024):
+        self.icon_size = icon_size
+        self.size = int(round(self.SIZES.get(icon_size, icon_size or 32) * scaling_factor))
+        self.icons = PixbufCache(max_bytes, self.on_evicted)
+        # Which window an application's icon came from
+        self.providers = {}
+        # Windows with an icon of their own
+        self.overrides = set()
+
+    def get_key(self, window, class_group):
+        if window in self.overrides or not class_group:
+            return ('window', window)
+
+        return ('class', class_group)
+
+    def get(self, window, class_group):
+        key = self.get_key(window, class_group)
+        if key in self.icons:
+            return self.icons.get(key)
+
+        icon = self.fetch(window)
+        self.store(key, icon)
+        self.providers[key] = window
+
+        return icon
+
+    def fetch(self, window):
+        with latency.span('icons'):
+            if self.icon_size == 'mini':
+                icon = window.get_mini_icon()
+            else:
+                icon = window.get_icon()
+
+            if icon is not None and (icon.get_width() != self.size or icon.get_height() != self.size):
+                icon = icon.scale_simple(self.size, self.size, GdkPixbuf.InterpType.BILINEAR)
+
+        return icon
+
+    def store(self, key, icon):
+        self.icons.store(key, icon, icon)
+
+    def discard(self, key):
+        self.icons.discard(key)
+        self.providers.pop(key, None)
+
+    def on_evicted(self, key):
+        self.providers.pop(key, None)
+
+    def icon_changed(self, window, class_group):
+        # Returns the class group whose shared icon changed, if any
+        if not class_group:
+            self.discard(('window', window))
+            return None
+
+        key = ('class', class_group)
+        icon = self.fetch(window)
+        # Its new icon is the application's, also when there's nothing cached
+        # anymore to compare against
+        if key not in self.icons or self.providers.get(key) is window:
+            self.overrides.discard(window)
+            self.discard(('window', window))
+            self.store(key, icon)
+            self.providers[key] = window
+            return class_group
+
+        # Some other window of the same application. Wnck also says so when a
+        # new window's icon comes in, which is usually the same one again.
+        if self.is_same_icon(icon, self.icons.peek(key)):
+            self.overrides.discard(window)
+            self.discard(('window', window))
+        else:
+            self.overrides.add(window)
+            self.store(('window', window), icon)
+            self.providers[('window', window)] = window
+        return None
+
+    def is_same_icon(self, icon, other):
+        if icon is None or other is None:
+            return icon is other
+
+        return (icon.get_width() == other.get_width() and icon.get_height() == other.get_height()
+            and icon.get_n_channels() == other.get_n_channels()
+            and icon.read_pixel_bytes().equal(other.read_pixel_bytes()))
+
+    def forget(self, window):
+        self.overrides.discard(window)
+        self.discard(('window', window))
+        for key in [key for key in self.providers if self.providers[key] is window]:
+            # Keep the icon, just don't tie it to a window that's gone
+            del self.providers[key]
+
+    def clear(self):
+        self.icons.clear()
+        self.providers.clear()
+        self.overrides.clear()
+
+
+class ScaledIconCaches():
+
+    # An IconCache per monitor scale, so moving between monitors doesn't mean
+    # fetching every icon again. Only the current scale's is used, but the
+    # others mustn't hold on to closed windows or changed icons meanwhile.
+
+    def __init__(self, make_cache, scale=1):
+        self.make_cache = make_cache
+        self.scale = scale
+        self.caches = {scale: make_cache(scale)}
+        self.icon_size = self.caches[scale].icon_size
+
+    def set_scale(self, scale):
+        if scale not in self.caches:
+            self.caches[scale] = self.make_cache(scale)
+        self.scale = scale
+
+    def get(self, window, class_group):
+        return self.caches[self.scale].get(window, class_group)
+
+    def icon_changed(self, window, class_group):
+        # The others are only told to let go, they fetch again when needed
+        for scale, cache in self.caches.items():
+            if scale != self.scale:
+                key = cache.get_key(window, class_group)
+                cache.forget(window)
+                cache.discard(key)
+
+        return self.caches[self.scale].icon_changed(window, class_group)
+
+    def forget(self, window):
+        for cache in self.caches.values():
+            cache.forget(window)
+
+    def clear(self):
+        for cache in self.caches.values():
+            cache.clear()
+
+
+class NoIcons():
+
+    # Stands in for IconCache when nobody's going to see the icons
+
+    icon_size = None
+
+    def get(self, window, class_group):
+        return None
+
+    def icon_changed(self, window, class_group):
+        return None
+
+    def forget(self, window):
+        pass
+
+    def clear(self):
+        pass
+
+
+class ThumbnailCache():
+
+    # Small pictures of windows, captured a few at a time when there's
+    # nothing else to do and kept until the window's title changes or it
+    # loses focus. They're taken straight from the X server: windows that
+    # aren't on screen keep the thumbnail they had, and without a compositor
+    # whatever is on top of a window ends up in its thumbnail too. That's
+    # why nothing is captured while the popup is up.
+
+    # Seconds of capturing per idle callback
+    BUDGET = 0.004
+    # Milliseconds the windows under the popup get to draw themselves again
+    RESUME_DELAY = 500
+
+    def __init__(self, source, width, max_bytes, callback):
+        self.source = source
+        self.width = width
+        # Window to (thumbnail, the title when it was taken)
+        self.thumbnails = PixbufCache(max_bytes, self.on_evicted)
+        self.stale = set()
+        self.queue = OrderedDict()
+        self.source_id = None
+        self.paused = False
+        self.resume_id = None
+        # Called with the window and its new thumbnail
+        self.callback = callback
+        self.handlers = [
+            source.connect('window-closed', self.on_window_closed),
+            source.connect('active-window-changed', self.on_active_window_changed),
+        ]
+
+    def get(self, window):
+        # The last thumbnail, even if a new one is on its way
+        if window not in self.thumbnails:
+            return None
+
+        thumbnail, name = self.thumbnails.get(window)
+        if name != window.get_name():
+            self.stale.add(window)
+
+        return thumbnail
+
+    def request(self, windows):
+        for window in windows:
+            if window not in self.thumbnails or window in self.stale:
+                self.queue[window] = True
+
+        self.schedule()
+
+    def schedule(self):
+        if self.queue and not self.paused and self.source_id is None:
+            self.source_id = GLib.idle_add(self.capture_queued, priority=GLib.PRIORITY_LOW)
+
+    def pause(self):
+        # Requests keep coming in, they wait until resume()
+        self.paused = True
+        if self.source_id is not None:
+            GLib.source_remove(self.source_id)
+            self.source_id = None
+        if self.resume_id is not None:
+            GLib.source_remove(self.resume_id)
+            self.resume_id = None
+
+    def resume(self):
+        if self.resume_id is None:
+            self.resume_id = GLib.timeout_add(self.RESUME_DELAY, self.on_resume)
+
+    def on_resume(self):
+        self.resume_id = None
+        self.paused = False
+        self.schedule()
+
+        return False
+
+    def capture_queued(self):
+        start = time.perf_counter()
+        while self.queue and time.perf_counter() - start < self.BUDGET:
+            window = self.queue.popitem(last=False)[0]
+            thumbnail = self.capture(window)
+            if thumbnail is not None:
+                self.callback(window, thumbnail)
+
+        if self.queue:
+            return True
+
+        self.source_id = None
+        return False
+
+    def capture(self, window):
+        with latency.span('thumbnails'):
+            name = window.get_name()
+            screenshot = self.source.capture_window(window)
+            if screenshot is None:
+                return None
+
+            # Very tall windows are cut off below the top square
+            width = screenshot.get_width()
+            if screenshot.get_height() > width:
+                screenshot = screenshot.new_subpixbuf(0, 0, width, width)
+            height = max(int(round(screenshot.get_height() * self.width / float(width))), 1)
+            thumbnail = screenshot.scale_simple(self.width, height, GdkPixbuf.InterpType.BILINEAR)
+
+        self.store(window, thumbnail, name)
+        return thumbnail
+
+    def store(self, window, thumbnail, name):
+        self.stale.discard(window)
+        self.thumbnails.store(window, (thumbnail, name), thumbnail)
+
+    def discard(self, window):
+        self.stale.discard(window)
+        self.thumbnails.discard(window)
+
+    def on_evicted(self, window):
+        self.stale.discard(window)
+
+    def on_window_closed(self, screen, window):
+        self.discard(window)
+        self.queue.pop(window, None)
+
+    def on_active_window_changed(self, screen, previous_window):
+        # Most likely the window that was being used looks different by now
+        if previous_window is not None and previous_window in self.thumbnails:
+            self.stale.add(previous_window)
+
+    def close(self):
+        for handler_id in self.handlers:
+            self.source.disconnect(handler_id)
+        self.pause()
+        self.thumbnails.clear()
+        self.queue.clear()
+        self.stale.clear()
+
+
+class WnckWindowSource():
+
+    # Windows as Wnck sees them on the default screen. This is the interface
+    # WindowList expects from a window source; ReplayWindowSource is the other
+    # implementation.
+
+    def __init__(self):
+        self.screen = None
+
+    def get_screen(self):
+        if self.screen is None:
+            self.screen = Wnck.Screen.get_default()
+
+        return self.screen
+
+    def force_update(self):
+        latency.count('x_round_trips')
+        self.get_screen().force_update()
+
+    def get_windows(self):
+        return self.get_screen().get_windows()
+
+    def get_active_window(self):
+        return self.get_screen().get_active_window()
+
+    def get_workspaces(self):
+        return self.get_screen().get_workspaces()
+
+    def get_workspace_count(self):
+        return self.get_screen().get_workspace_count()
+
+    def get_active_workspace(self):
+        return self.get_screen().get_active_workspace()
+
+    def capture_window(self, window):
+        # Straight from the X server, so only windows that are on screen
+        if window.is_minimized() or not window.is_visible_on_workspace(self.get_active_workspace()):
+            return None
+
+        latency.count('x_round_trips')
+        display = Gdk.Display.get_default()
+        # The window may be gone by now
+        display.error_trap_push()
+        try:
+            gdk_window = GdkX11.X11Window.foreign_new_for_display(display, window.get_xid())
+            if gdk_window is None:
+                return None
+            return Gdk.pixbuf_get_from_window(gdk_window, 0, 0, gdk_window.get_width(), gdk_window.get_height())
+        finally:
+            display.error_trap_pop_ignored()
+
+    def connect(self, signal_name, handler, *data):
+        return self.get_screen().connect(signal_name, handler, *data)
+
+    def disconnect(self, handler_id):
+        self.get_screen().disconnect(handler_id)
+
+
+class ReplaySignals():
+
+    # Just enough of GObject's signals for WindowList
+
+    def __init__(self):
+        self.handlers = {}
+        self.handler_id = 0
+
+    def connect(self, signal_name, handler, *data):
+        self.handler_id += 1
+        self.handlers[self.handler_id] = (signal_name, handler, data)
+        return self.handler_id
+
+    def disconnect(self, handler_id):
+        del self.handlers[handler_id]
+
+    def emit(self, signal_name, *args):
+        for name, handler, data in list(self.handlers.values()):
+            if name == signal_name:
+                handler(self, *(args + data))
+
+
+class ReplayWorkspace(ReplaySignals):
+
+    def __init__(self, source, number):
+        ReplaySignals.__init__(self)
+        self.source = source
+        self.number = number
+
+    def get_number(self):
+        return self.number
+
+    def activate(self, time):
+        self.source.activate_workspace(self.number)
+
+
+class ReplayWindow(ReplaySignals):
+
+    def __init__(self, source, name, class_group, workspace, window_type, pid, role=None, xid=0):
+        ReplaySignals.__init__(self)
+        self.source = source
+        self.xid = xid
+        self.name = name
+        self.class_group = class_group
+        self.workspace = workspace
+        self.window_type = window_type
+        self.pid = pid
+        self.role = role
+
+    def get_name(self):
+        return self.name
+
+    def get_class_group_name(self):
+        return self.class_group
+
+    def get_workspace(self):
+        return self.workspace
+
+    def get_window_type(self):
+        return getattr(Wnck.WindowType, self.window_type.upper())
+
+    def get_pid(self):
+        return self.pid
+
+    def get_xid(self):
+        return self.xid
+
+    def get_role(self):
+        return self.role
+
+    def get_icon(self):
+        return self.source.icon
+
+    def get_mini_icon(self):
+        return self.source.icon
+
+    def activate(self, time):
+        self.source.activate_window(self)
+
+    def close(self, time):
+        self.source.close_window(self)
+
+
+class ReplayWindowSource(ReplaySignals):
+
+    # Windows that only exist in memory, driven by calling the methods below
+    # directly or by replaying a trace recorded with TraceRecorder. Useful to
+    # load-test and profile the model without an X session.
+
+    def __init__(self, workspace_count=1, icon=None):
+        ReplaySignals.__init__(self)
+        self.icon = icon
+        self.windows = []
+        self.windows_by_id = {}
+        self.workspaces = []
+        self.active_window = None
+        self.active_workspace = None
+        self.set_workspace_count(workspace_count)
+
+    def force_update(self):
+        pass
+
+    def get_windows(self):
+        return self.windows
+
+    def get_active_window(self):
+        return self.active_window
+
+    def get_workspaces(self):
+        return self.workspaces
+
+    def get_workspace_count(self):
+        return len(self.workspaces)
+
+    def get_active_workspace(self):
+        return self.active_workspace
+
+    def capture_window(self, window):
+        # Nothing to capture, the icon will do
+        return self.icon
+
+    def get_workspace(self, number):
+        if number is None:
+            return None
+
+        return self.workspaces[number]
+
+    def open_window(self, name, class_group=None, workspace=0, window_type='normal', pid=0, window_id=None, role=None):
+        window = ReplayWindow(self, name, class_group, self.get_workspace(workspace), window_type, pid, role, window_id or 0)
+        self.windows.append(window)
+        if window_id is not None:
+            self.windows_by_id[window_id] = window
+        self.emit('window-opened', window)
+
+        return window
+
+    def close_window(self, window):
+        self.windows.remove(window)
+        if self.active_window is window:
+            self.activate_window(None)
+        self.emit('window-closed', window)
+
+    def rename_window(self, window, name):
+        window.name = name
+        window.emit('name-changed')
+
+    def move_window(self, window, workspace):
+        window.workspace = self.get_workspace(workspace)
+        window.emit('workspace-changed')
+
+    def activate_window(self, window):
+        previous_window = self.active_window
+        self.active_window = window
+        self.emit('active-window-changed', previous_window)
+
+    def activate_workspace(self, number):
+        previous_workspace = self.active_workspace
+        self.active_workspace = self.workspaces[number]
+        self.emit('active-workspace-changed', previous_workspace)
+
+    def set_workspace_count(self, count):
+        while len(self.workspaces) < count:
+            workspace = ReplayWorkspace(self, len(self.workspaces))
+            self.workspaces.append(workspace)
+            self.emit('workspace-created', workspace)
+
+        while len(self.workspaces) > count:
+            workspace = self.workspaces.pop()
+            # Windows on a workspace that goes away end up on the last one left
+            for window in self.windows:
+                if window.workspace is workspace:
+                    self.move_window(window, count - 1)
+            if self.active_workspace is workspace:
+                self.activate_workspace(count - 1)
+            self.emit('workspace-destroyed', workspace)
+
+        if self.active_workspace is None and self.workspaces:
+            self.active_workspace = self.workspaces[0]
+
+    def apply(self, event):
+        # One event of a trace, see TraceRecorder for what they look like
+        kind = event['event']
+        window = self.windows_by_id.get(event.get('id'))
+
+        if kind == 'open':
+            self.open_window(
+                event['name'],
+                event.get('class_group'),
+                event.get('workspace'),
+                event.get('type', 'normal'),
+                event.get('pid', 0),
+                event['id'],
+                event.get('role')
+            )
+        elif kind == 'workspaces':
+            self.set_workspace_count(event['count'])
+        elif kind == 'active_workspace':
+            self.activate_workspace(event['workspace'])
+        elif window is None:
+            # Events for windows from before the recording started
+            return
+        elif kind == 'close':
+            del self.windows_by_id[event['id']]
+            self.close_window(window)
+        elif kind == 'rename':
+            self.rename_window(window, event['name'])
+        elif kind == 'move':
+            self.move_window(window, event['workspace'])
+        elif kind == 'activate':
+            self.activate_window(window)
+
+    def replay(self, events):
+        # As fast as possible, the timestamps are only there for reference
+        count = 0
+        for event in events:
+            self.apply(event)
+            count += 1
+
+        return count
+
+
+def load_trace(path):
+    with open(path) as trace:
+        return [json.loads(line) for line in trace if line.strip()]
+
+
+class TraceRecorder():
+
+    # Writes what happens on a window source to a trace file, one JSON object
+    # per line, for ReplayWindowSource to play back later:
+    #
+    #   {"t": 0.25, "event": "open", "id": 52428807, "name": "Terminal",
+    #    "class_group": "Gnome-terminal", "workspace": 1, "type": "normal", "pid": 4242,
+    #    "role": "gnome-terminal-window-4242"}
+    #   {"t": 1.5, "event": "rename", "id": 52428807, "name": "~/src"}
+    #   {"t": 2.0, "event": "move", "id": 52428807, "workspace": null}
+    #   {"t": 2.5, "event": "activate", "id": 52428807}
+    #   {"t": 3.0, "event": "close", "id": 52428807}
+    #   {"t": 4.0, "event": "workspaces", "count": 4}
+    #   {"t": 4.5, "event": "active_workspace", "workspace": 2}
+
+    def __init__(self, source, path):
+        self.source = source
+        self.trace = open(path, 'a')
+        self.start = time.time()
+
+        # The windows that are already there count as opened right away
+        self.write('workspaces', count=source.get_workspace_count())
+        for window in source.get_windows():
+            self.on_window_opened(source, window)
+
+        source.connect('window-opened', self.on_window_opened)
+        source.connect('window-closed', self.on_window_closed)
+        source.connect('workspace-created', self.on_workspaces_changed)
+        source.connect('workspace-destroyed', self.on_workspaces_changed)
+        source.connect('active-workspace-changed', self.on_active_workspace_changed)
+        source.connect('active-window-changed', self.on_active_window_changed)
+
+    def write(self, event, **fields):
+        fields['t'] = round(time.time() - self.start, 3)
+        fields['event'] = event
+        self.trace.write(json.dumps(fields) + '\n')
+        self.trace.flush()
+
+    def get_workspace_number(self, window):
+        workspace = window.get_workspace()
+        if workspace is None:
+            return None
+
+        return workspace.get_number()
+
+    def on_window_opened(self, screen, window):
+        self.write('open',
+            id=window.get_xid(),
+            name=window.get_name(),
+            class_group=window.get_class_group_name(),
+            workspace=self.get_workspace_number(window),
+            type=window.get_window_type().value_nick,
+            pid=window.get_pid(),
+            role=window.get_role()
+        )
+        window.connect('name-changed', self.on_name_changed)
+        window.connect('workspace-changed', self.on_workspace_changed)
+
+    def on_window_closed(self, screen, window):
+        self.write('close', id=window.get_xid())
+
+    def on_name_changed(self, window):
+        self.write('rename', id=window.get_xid(), name=window.get_name())
+
+    def on_workspace_changed(self, window):
+        self.write('move', id=window.get_xid(), workspace=self.get_workspace_number(window))
+
+    def on_workspaces_changed(self, screen, workspace):
+        self.write('workspaces', count=self.source.get_workspace_count())
+
+    def on_active_workspace_changed(self, screen, previous_workspace):
+        workspace = self.source.get_active_workspace()
+        if workspace is not None:
+            self.write('active_workspace', workspace=workspace.get_number())
+
+    def on_active_window_changed(self, screen, previous_window):
+        window = self.source.get_active_window()
+        if window is not None:
+            self.write('activate', id=window.get_xid())
+
+
+class WindowRules():
+
+    # Decides which windows make it into the list. Rules are regexes matched
+    # against the window title, or against another property when prefixed:
+    #
+    #   ^unity-panel$           the title
+    #   title:^unity-panel$     the same
+    #   class:^Plank$           the class group
+    #   type:^(dock|desktop)$   the window type, as in show_windows_<type>
+    #   role:^pop-up$           the WM_WINDOW_ROLE
+    #
+    # All rules on a property are combined into one regex, so a window is
+    # matched once per property no matter how many rules there are. Decisions
+    # are remembered per window until anything they depend on changes.
+
+    FIELDS = ('title', 'class', 'type', 'role')
+
+    def __init__(self, ignored_windows, always_show_windows, ignored_window_types):
+        self.ignored = self.compile(ignored_windows)
+        self.always_shown = self.compile(always_show_windows)
+        self.ignored_window_types = ignored_window_types
+        # Only look up what some rule actually needs, roles are a round-trip each
+        self.fields = set(self.ignored) | set(self.always_shown)
+        self.decisions = {}
+
+    def compile(self, rules):
+        patterns = {}
+        for rule in rules:
+            field, pattern = self.parse(rule)
+            # Catch broken rules one by one, the combined error would be no help
+            re.compile(pattern)
+            patterns.setdefault(field, []).append(pattern)
+
+        compiled = {}
+        for field, field_patterns in patterns.items():
+            # Numbered group references would point at another rule's groups once combined
+            if not any(re.search(r'\\[1-9]', pattern) for pattern in field_patterns):
+                try:
+                    compiled[field] = [re.compile('|'.join('(?:%s)' % self.scope_flags(pattern) for pattern in field_patterns))]
+                    continue
+                except re.error:
+                    # Such as the same group name in two rules
+                    pass
+            compiled[field] = [re.compile(pattern) for pattern in field_patterns]
+
+        return compiled
+
+    def parse(self, rule):
+        field, separator, pattern = rule.partition(':')
+        if separator and field in self.FIELDS:
+            return field, pattern
+
+        return 'title', rule
+
+    def scope_flags(self, pattern):
+        # Leading flags like (?i) apply to the whole regex, keep them to this rule
+        flags = re.match(r'\(\?([aiLmsux]+)\)', pattern)
+        if flags is None:
+            return pattern
+
+        return '(?%s:%s)' % (flags.group(1), pattern[flags.end():])
+
+    def decide(self, window, name, class_group, window_type):
+        # One of 'always', 'shown' or 'ignored'
+        key = (name, class_group, window_type)
+        decision = self.decisions.get(window)
+        if decision is not None and decision[0] == key:
+            return decision[1]
+
+        values = {'title': name, 'class': class_group}
+        if 'type' in self.fields:
+            values['type'] = window_type.value_nick
+        if 'role' in self.fields:
+            values['role'] = window.get_role()
+
+        if self.matches(self.always_shown, values):
+            decision = 'always'
+        elif window_type in self.ignored_window_types or self.matches(self.ignored, values):
+            decision = 'ignored'
+        else:
+            decision = 'shown'
+
+        self.decisions[window] = (key, decision)
+        return decision
+
+    def matches(self, rules, values):
+        for field, patterns in rules.items():
+            value = values[field]
+            if value is None:
+                continue
+            for pattern in patterns:
+                if pattern.search(value) is not None:
+                    return True
+
+        return False
+
+    def forget(self, window):
+        self.decisions.pop(window, None)
+
+    def retain(self, windows):
+        # Drop what's remembered about windows that are gone
+        self.decisions = {window: self.decisions[window] for window in windows if window in self.decisions}
+
+
+class ProcessInfo():
+
+    # What /proc has to say about the process behind a window and its
+    # children: executables, command lines and working directories, as one
+    # lowercase string to search. Read in a thread pool and handed over on the
+    # main loop, so refreshing and typing never wait for /proc.
+
+    # Children of a process that count, a shell or two in a terminal
+    MAX_CHILDREN = 8
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.executor = None
+        # Paths under it are searchable the way you'd type them, as ~/src/foo
+        self.home = os.path.expanduser('~').rstrip('/')
+        # PID to what was found, None until it's been read
+        self.info = {}
+        self.pending = set()
+        # Called with the PID once its information came in
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get(self, pid):
+        # Whatever is known right now, reading it if need be
+        if not pid:
+            return None
+
+        if pid not in self.info:
+            self.info[pid] = None
+            self.read_later(pid)
+
+        return self.info[pid]
+
+    def invalidate(self, pid):
+        # The old information stays until the new one is in
+        if pid in self.info:
+            self.read_later(pid)
+
+    def forget(self, pid):
+        # PIDs get reused
+        self.info.pop(pid, None)
+
+    def read_later(self, pid):
+        if pid in self.pending:
+            return
+
+        if self.executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(self.workers)
+        self.pending.add(pid)
+        future = self.executor.submit(self.read, pid)
+        future.add_done_callback(lambda future: GLib.idle_add(self.deliver, pid, future))
+
+    def deliver(self, pid, future):
+        self.pending.discard(pid)
+        # Forgotten in the meantime
+        if pid not in self.info:
+            return False
+
+        self.info[pid] = future.result()
+        for listener in self.listeners:
+            listener(pid)
+
+        return False
+
+    def read(self, pid):
+        # In a worker thread
+        fields = []
+        for process in [pid] + self.get_children(pid)[:self.MAX_CHILDREN]:
+            for name in ('exe', 'cwd'):
+                try:
+                    fields.append(os.readlink('/proc/%d/%s' % (process, name)))
+                except OSError:
+                    pass
+            try:
+                with open('/proc/%d/cmdline' % process, 'rb') as cmdline:
+                    fields.append(cmdline.read().replace(b'\0', b' ').decode('utf-8', 'replace').strip())
+            except EnvironmentError:
+                pass
+
+        # Both ways, the full path still has to match as well
+        if self.home:
+            fields += [field.replace(self.home, '~') for field in fields if self.home in field]
+
+        return ' '.join(fields).lower()
+
+    def get_children(self, pid):
+        children = []
+        try:
+            for thread in os.listdir('/proc/%d/task' % pid):
+                with open('/proc/%d/task/%s/children' % (pid, thread)) as thread_children:
+                    children.extend([int(child) for child in thread_children.read().split()])
+        except (EnvironmentError, ValueError):
+            pass
+
+        return children
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+class ActivationHistory():
+
+    # Which windows were picked after typing what, so that the window you
+    # usually want comes first after a keystroke or two. Kept in an
+    # append-only file of JSON lines that's compacted once it has grown to
+    # twice its size, and only read once it's needed:
+    #
+    #   {"t": 1700000000.0, "query": "fi", "class_group": "Firefox", "title": "Inbox"}
+
+    # Most a window's score can go up by, about four typed characters
+    BONUS = 64
+    # The frecency at which half of that bonus is reached
+    SATURATION = 100
+    # Longer queries are cut short, nobody types that much to switch windows
+    MAX_QUERY = 32
+
+    def __init__(self, path=None, size=1000):
+        if path is None:
+            data_home = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+            path = os.path.join(data_home, 'nimbler', 'history.jsonl')
+        self.path = path
+        self.size = size
+        self.activations = deque(maxlen=size)
+        self.lines = 0
+        self.loaded = False
+        self.indexed = None
+        # Query prefix, '' for any query, to frecency per window and per application
+        self.index = {}
+
+    def load(self):
+        if self.loaded:
+            return
+
+        self.loaded = True
+        try:
+            with open(self.path) as history:
+                for line in history:
+                    self.lines += 1
+                    try:
+                        activation = json.loads(line)
+                        self.activations.append((activation['t'], activation['query'],
+                            activation['class_group'], activation['title']))
+                    except (ValueError, KeyError, TypeError):
+                        # Cut short by a crash or so
+                        pass
+        except EnvironmentError:
+            pass
+
+        if self.lines > 2 * self.size:
+            self.compact()
+        self.reindex()
+
+    def reindex(self):
+        self.index = {}
+        self.indexed = time.time()
+        for activation in self.activations:
+            self.add_to_index(*activation)
+
+    def get_weight(self, timestamp):
+        # Recent activations count for more, like browsers do for history
+        age = (self.indexed - timestamp) / 86400
+        for days, weight in ((4, 100), (14, 70), (31, 50), (90, 30)):
+            if age < days:
+                return weight
+
+        return 10
+
+    def add_to_index(self, timestamp, query, class_group, title):
+        weight = self.get_weight(timestamp)
+        for i in range(len(query) + 1):
+            prefix = self.index.setdefault(query[:i], {})
+            for key in (('title', class_group, title), ('class', class_group)):
+                prefix[key] = prefix.get(key, 0) + weight
+
+    def record(self, query, class_group, title):
+        self.load()
+        activation = (time.time(), query.lower()[:self.MAX_QUERY], class_group, title)
+        self.activations.append(activation)
+        self.add_to_index(*activation)
+
+        try:
+            directory = os.path.dirname(self.path)
+            # What you typed and the titles of your windows are nobody else's business
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            with self.open_private(self.path, os.O_APPEND) as history:
+                history.write(json.dumps(dict(zip(('t', 'query', 'class_group', 'title'), activation))) + '\n')
+            self.lines += 1
+            if self.lines > 2 * self.size:
+                self.compact()
+        except EnvironmentError as error:
+            print("Could not save the activation history:", error)
+
+    def compact(self):
+        # Only the most recent activations are kept, written out in one go
+        temporary = self.path + '.tmp'
+        try:
+            with self.open_private(temporary, os.O_TRUNC) as history:
+                for activation in self.activations:
+                    history.write(json.dumps(dict(zip(('t', 'query', 'class_group', 'title'), activation))) + '\n')
+            os.rename(temporary, self.path)
+            self.lines = len(self.activations)
+        except EnvironmentError as error:
+            print("Could not compact the activation history:", error)
+
+    def open_private(self, path, flags):
+        # Readable by us only, even while it's being created
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | flags, 0o600)
+        # Files written before this was looked after may not be
+        os.fchmod(fd, 0o600)
+        return os.fdopen(fd, 'w')
+
+    def score(self, text, class_group, title):
+        # A bonus for windows picked before after typing something like text
+        self.load()
+        # Ages are worked out when indexing, that shouldn't get too far behind
+        if time.time() - self.indexed > 86400:
+            self.reindex()
+
+        frecency = 0
+        # Picked after typing this very text counts double
+        for prefix, factor in ((text[:self.MAX_QUERY], 2), ('', 1)):
+            weights = self.index.get(prefix)
+            if weights:
+                frecency += factor * weights.get(('title', class_group, title), 0)
+                frecency += factor * weights.get(('class', class_group), 0) / 2.0
+
+        if not frecency:
+            return 0
+
+        return int(self.BONUS * frecency / (frecency + self.SATURATION))
+
+
+class WindowRecord():
+
+    # A window as the list shows it. There's one for as long as the window
+    # is shown, it's updated in place and its id never changes; ids go up in
+    # the order windows were first seen, which is also the display order.
+
+    __slots__ = ('id', 'window', 'name', 'class_group', 'icon', 'process', 'rank', 'positions')
+
+    def __init__(self, id, window):
+        self.id = id
+        self.window = window
+        self.name = None
+        self.class_group = None
+        self.icon = None
+        self.process = None
+        # Only meaningful for the latest ranking
+        self.rank = 0
+        self.positions = None
+
 
 class WindowList():
 
-    def __init__(self, ignored_windows, always_show_windows, ignored_window_types, icon_size):
+    def __init__(self, ignored_windows, always_show_windows, ignored_window_types, icon_size, source=None, icon_cache=None, processes=None, history=None):
         self.windowList = []
-        self.max_windows = 0
+        self.window_list_merged = []
+        self.entries = {}
+        self.ranked = []
+        self.ranked_text = ''
+        self.ranked_generation = None
         self.previousWindow = None
         self.fuzzyMatcher = FuzzyMatcher()
-        self.ignored_windows = ignored_windows
-        self.always_show_windows = always_show_windows
-        self.ignored_window_types = ignored_window_types
+        # Narrow down what rank() has to score, processes go by their text
+        # since many windows can share one
+        self.index = CharacterIndex()
+        self.process_index = SubstringIndex()
+        self.process_windows = {}
+        self.rules = WindowRules(ignored_windows, always_show_windows, ignored_window_types)
         self.icon_size = icon_size
+        if icon_cache is None:
+            icon_cache = IconCache(icon_size)
+        self.icon_cache = icon_cache
+        # Searching processes as well, when given a ProcessInfo
+        self.processes = None
+        self.set_processes(processes)
+        # Windows picked before come first, when given an ActivationHistory
+        self.history = history
+        # Where the windows come from, Wnck's default screen unless told otherwise
+        if source is None:
+            source = WnckWindowSource()
+        self.source = source
+        # Set when the model is kept current through the source's signals, see watch()
+        self.watching = False
+        self.source_handlers = []
+        self.window_handlers = {}
+        self.sequences = {}
+        self.sequence = 0
+        self.dirty = False
+        # Bumped on every change so views can tell whether they're out of date
+        self.generation = 0
+        # Called on every change, they had better be quick about it
+        self.listeners = []
 
     def refresh(self):
-        # Clear existing
-        self.windowList = []
+        # A watched source is always current, only the grouping may be stale
+        if self.watching:
+            if self.dirty:
+                self.regroup()
+            return
 
         # Get the screen and force update
-        screen = Wnck.Screen.get_default()
-        screen.force_update()
-        
-        # Get the workspaces
-        self.workspace_count = Wnck.Screen.get_workspace_count(screen)
-        self.workspaces = Wnck.Screen.get_workspaces(screen)
-        self.active_workspace = Wnck.Screen.get_active_workspace(screen)
-        
-        # Set up the top list (is there a more efficient way?)
-        for i in range(len(self.workspaces)):
-            self.windowList.append([])
+        self.source.force_update()
+
+        self.rebuild()
+
+    def rebuild(self):
+        # Records of windows that are still around are reused as is
+        entries = self.entries
+        self.entries = {}
 
         # Get previous active window
-        self.previousWindow = screen.get_active_window()
+        self.previousWindow = self.source.get_active_window()
 
         # Get a list of windows
-        window_list = screen.get_windows()
-        for i in window_list:
-            name = i.get_name()
-            workspace = i.get_workspace()
-            window_type = i.get_window_type()
-            class_group = i.get_class_group_name()
-
-            # Filter out extraneous windows
-            if self.isWindowAlwaysShown(name):
-                pass
-            else:
-                if window_type in self.ignored_window_types:
-                    continue
+        windows = self.source.get_windows()
+        for window in windows:
+            self.add_window(window, entries.get(window))
+        for window, entry in entries.items():
+            if self.entries.get(window) is not entry:
+                self.forget_entry(entry)
+        self.rules.retain(windows)
+        self.sequences = dict([(window, self.sequences[window]) for window in windows if window in self.sequences])
+
+        self.update_workspaces()
+        self.regroup()
+        self.generation += 1
+
+    def watch(self):
+        # Build the model once, then keep it current from the source's signals
+        # so that opening the popup never has to go back to the X server
+        self.source.force_update()
+
+        self.watching = True
+        self.rebuild()
+
+        for window in self.source.get_windows():
+            self.watch_window(window)
+
+        for signal_name, handler in (
+            ('window-opened', self.on_window_opened),
+            ('window-closed', self.on_window_closed),
+            ('workspace-created', self.on_workspaces_changed),
+            ('workspace-destroyed', self.on_workspaces_changed),
+            ('active-workspace-changed', self.on_workspaces_changed),
+            ('active-window-changed', self.on_active_window_changed),
+        ):
+            self.source_handlers.append(self.source.connect(signal_name, handler))
+
+    def unwatch(self):
+        if not self.watching:
+            return
 
-                if self.isWindowIgnored(name):
-                    continue
-            
-            # Construct workspace/window array
-            #print('workspace ' + str(workspace) + name)
-            #print('workspace index ' + str(self.workspaces.index(workspace)))
+        for handler_id in self.source_handlers:
+            self.source.disconnect(handler_id)
+        for window, handler_ids in self.window_handlers.items():
+            for handler_id in handler_ids:
+                window.disconnect(handler_id)
+
+        self.source_handlers = []
+        self.window_handlers = {}
+        self.watching = False
+
+    def watch_window(self, window):
+        self.window_handlers[window] = [
+            window.connect('name-changed', self.on_window_changed),
+            window.connect('class-changed', self.on_window_changed),
+            window.connect('type-changed', self.on_window_changed),
+            window.connect('workspace-changed', self.on_window_changed),
+            window.connect('icon-changed', self.on_icon_changed),
+        ]
+
+    def on_window_opened(self, screen, window):
+        self.watch_window(window)
+        self.add_window(window)
+        self.changed()
+
+    def on_window_closed(self, screen, window):
+        for handler_id in self.window_handlers.pop(window, []):
+            window.disconnect(handler_id)
+
+        self.sequences.pop(window, None)
+        self.rules.forget(window)
+        if self.processes is not None:
+            pid = window.get_pid()
+            if not [entry for entry in self.entries.values() if entry.window is not window and entry.window.get_pid() == pid]:
+                self.processes.forget(pid)
+        self.icon_cache.forget(window)
+        entry = self.entries.pop(window, None)
+        if entry is not None:
+            self.forget_entry(entry)
+            self.changed()
+
+    def on_window_changed(self, window):
+        # A new title often means a new working directory or command
+        if self.processes is not None:
+            self.processes.invalidate(window.get_pid())
+
+        # Filtering and placement may both be affected, so start over for this window
+        self.add_window(window, self.entries.pop(window, None))
+        self.changed()
+
+    def on_icon_changed(self, window):
+        class_group = window.get_class_group_name()
+        shared_class_group = self.icon_cache.icon_changed(window, class_group)
+
+        # Either every window of the application or just this one
+        updated = False
+        for entry in self.entries.values():
+            if entry.window is window or (shared_class_group and entry.class_group == shared_class_group):
+                entry.icon = self.get_icon(entry.window, entry.class_group)
+                updated = True
+
+        if updated:
+            self.changed()
+
+    def on_workspaces_changed(self, screen, *args):
+        self.update_workspaces()
+        self.changed()
+
+    def on_active_window_changed(self, screen, previous_window):
+        active_window = self.source.get_active_window()
+        # Don't count ourselves, we only get focus while the popup is open
+        if active_window is not None and active_window.get_pid() != os.getpid():
+            self.previousWindow = active_window
+
+    def changed(self):
+        self.dirty = True
+        self.generation += 1
+
+        for listener in self.listeners:
+            listener()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def add_window(self, window, entry=None):
+        # Windows keep their original position even when they change
+        if window not in self.sequences:
+            self.sequence += 1
+            self.sequences[window] = self.sequence
+
+        name = window.get_name()
+        class_group = window.get_class_group_name()
+
+        # Filter out extraneous windows
+        with latency.span('filter'):
+            decision = self.rules.decide(window, name, class_group, window.get_window_type())
+        if decision == 'ignored':
+            self.forget_entry(entry)
+            return
+
+        # The popup itself only shows up while it's open
+        if decision != 'always' and self.watching and window.get_pid() == os.getpid():
+            self.forget_entry(entry)
+            return
+
+        if entry is None:
+            entry = WindowRecord(self.sequences[window], window)
+        entry.name = name
+        entry.class_group = class_group
+        entry.icon = self.get_icon(window, class_group)
+        self.index.update(entry, name, class_group)
+        self.set_entry_process(entry, self.get_process(window))
+        self.entries[window] = entry
+
+    def forget_entry(self, entry):
+        # For a window that's no longer shown
+        if entry is not None:
+            self.index.remove(entry)
+            self.set_entry_process(entry, None)
+
+    def set_entry_process(self, entry, process):
+        if entry.process and entry.process != process:
+            windows = self.process_windows.get(entry.process)
+            if windows is not None:
+                windows.discard(entry)
+                if not windows:
+                    del self.process_windows[entry.process]
+                    self.process_index.remove(entry.process)
+
+        entry.process = process
+        if process:
+            if process not in self.process_windows:
+                self.process_windows[process] = set()
+                self.process_index.update(process, process)
+            self.process_windows[process].add(entry)
+
+    def update_workspaces(self):
+        # Get the workspaces
+        self.workspace_count = self.source.get_workspace_count()
+        self.workspaces = self.source.get_workspaces()
+        self.active_workspace = self.source.get_active_workspace()
+
+    def regroup(self):
+        # Set up the top list
+        self.windowList = [[] for workspace in self.workspaces]
+        columns = dict([(workspace, self.windowList[i]) for i, workspace in enumerate(self.workspaces)])
+
+        # Construct workspace/window array in the order the windows were opened
+        for entry in sorted(self.entries.values(), key=lambda x: x.id):
             # A window on every workspace will have workspace None
-            if workspace:
-                self.windowList[self.workspaces.index(workspace)].append({
-                    'name': name,
-                    'icon': self.get_icon(i),
-                    'class_group': class_group,
-                    'window': i, 'rank': 0
-                })
             # Pretend the always on visible workspace window is on the active workspace
-            else:
-                self.windowList[self.workspaces.index(self.active_workspace)].append({
-                    'name': name,
-                    'icon': self.get_icon(i),
-                    'class_group': class_group,
-                    'window': i, 'rank': 0
-                })
-        
-        # Determine the maximum amount of windows that needs to go under a specific workspace
-        for i in self.windowList:
-            if self.max_windows < len(i):
-                self.max_windows = len(i)
-                
+            column = columns.get(entry.window.get_workspace())
+            if column is None:
+                column = columns[self.active_workspace]
+            column.append(entry)
+
         # Merged correctly ordered list for switching purposes
         # Via http://stackoverflow.com/a/952952
-        self.window_list_merged = [item for sublist in self.windowList for item in sublist]
-
-    def get_icon(self, window):
-        if self.icon_size == 'default' or type(self.icon_size) is int:
-            return window.get_icon()
-        elif self.icon_size == 'mini':
-            return window.get_mini_icon()
+        self.window_list_merged = tuple([item for sublist in self.windowList for item in sublist])
+        self.dirty = False
+
+    def get_icon(self, window, class_group):
+        return self.icon_cache.get(window, class_group)
+
+    def get_process(self, window):
+        if self.processes is None:
+            return None
+
+        return self.processes.get(window.get_pid())
+
+    def set_processes(self, processes):
+        if self.processes is not None:
+            self.processes.listeners.remove(self.on_process_info)
+        self.processes = processes
+        if processes is not None:
+            processes.add_listener(self.on_process_info)
+
+        for entry in self.entries.values():
+            self.set_entry_process(entry, self.get_process(entry.window))
+        if self.entries:
+            self.changed()
+
+    def on_process_info(self, pid):
+        updated = False
+        for entry in self.entries.values():
+            if entry.window.get_pid() == pid:
+                self.set_entry_process(entry, self.processes.info[pid])
+                updated = True
+
+        if updated:
+            self.changed()
+
+    def set_rules(self, ignored_windows, always_show_windows, ignored_window_types):
+        self.rules = WindowRules(ignored_windows, always_show_windows, ignored_window_types)
+
+        # Without watching, the next refresh starts from scratch anyway
+        if self.watching:
+            self.entries = {}
+            self.index.clear()
+            self.process_index.clear()
+            self.process_windows = {}
+            for window in self.source.get_windows():
+                self.add_window(window)
+            self.changed()
+
+    def set_icon_cache(self, icon_cache):
+        self.icon_cache = icon_cache
+        self.icon_size = icon_cache.icon_size
+
+        for entry in self.entries.values():
+            entry.icon = self.get_icon(entry.window, entry.class_group)
+        self.changed()
     
     def getLatest(self):
         self.refresh()
@@ -170,220 +2111,717 @@ class WindowList():
         return self.windowList
         
     def get_max_windows(self):
-        return self.max_windows
+        # Determine the maximum amount of windows that needs to go under a specific workspace
+        return max([len(i) for i in self.windowList] or [0])
             
     def get_workspace_count(self):
         return self.workspace_count
 
     def getHighestRanked(self):
-        if (len(self.windowList)):
-            return self.windowList[0]
+        if (len(self.ranked)):
+            return self.ranked[0]
 
         return None
 
     def rank(self, text):
-        self.fuzzyMatcher.setPattern(text.lower())
-        for i in self.window_list_merged:
-            score = self.fuzzyMatcher.score(i['name'].lower())
-            if i['class_group']:
-                score += self.fuzzyMatcher.score(i['class_group'].lower())
-            i['rank'] = score
+        text = text.lower()
 
-        self.window_list_merged.sort(key=lambda x: x['rank'], reverse=True)
+        # When the query only got longer, anything that didn't match before
+        # can't match now either, so only the previous matches need scoring
+        if (self.ranked_text and text.startswith(self.ranked_text)
+                and self.ranked_generation == self.generation):
+            candidates = self.ranked
+        else:
+            candidates = self.window_list_merged
+
+        self.fuzzyMatcher.setPattern(text)
+        ranked = []
+        for i in self.candidates(text, candidates):
+            i.rank, i.positions = self.score(i, text)
+            if i.rank > 0:
+                ranked.append(i)
+
+        # The display order in window_list_merged is what the shortcuts refer
+        # to, so the ranking goes into a list of its own; ties go by display order
+        ranked.sort(key=lambda x: (-x.rank, x.id))
+        self.ranked = ranked
+        self.ranked_text = text
+        self.ranked_generation = self.generation
+
+        return self.ranked
+
+    def best_match(self, text):
+        # The same ranking as rank(), but the popup's own is left alone, so
+        # this can run while it's open
+        text = text.lower()
+        self.fuzzyMatcher.setPattern(text)
+        best, best_key = None, None
+        for i in self.candidates(text, self.window_list_merged):
+            key = (-self.score(i, text)[0], i.id)
+            if key[0] < 0 and (best is None or key < best_key):
+                best, best_key = i, key
+        return best
+
+    def candidates(self, text, entries):
+        # Only windows that have every character that was typed, or a
+        # process that may contain it, can match
+        matches = self.index.lookup(text)
+        if matches is None:
+            return entries
+        matches = set(matches)
+        for process in self.process_index.lookup(text):
+            matches.update(self.process_windows[process])
+        return [i for i in entries if i in matches]
+
+    def score(self, entry, text):
+        # The pattern has to be set already; returns the score and where the
+        # name matched
+        match = self.fuzzyMatcher.match(entry.name)
+        if match is not None:
+            score, positions = match
+        else:
+            score, positions = 0, None
+        if entry.class_group:
+            score += self.fuzzyMatcher.score(entry.class_group)
+        # Long command lines would match almost anything as a
+        # subsequence, so these have to contain what was typed as is
+        if entry.process and text in entry.process:
+            score += FuzzyMatcher.SCORE_MATCH * len(text)
+        # Only for windows that match in the first place
+        if score > 0 and self.history is not None:
+            score += self.history.score(text, entry.class_group, entry.name)
+        return score, positions
+
+    def record_activation(self, window, query):
+        entry = self.entries.get(window)
+        if self.history is not None and entry is not None:
+            self.history.record(query, entry.class_group, entry.name)
+
+    def reset_rank(self):
+        self.ranked = []
+        self.ranked_text = ''
+        self.ranked_generation = None
 
     def getPreviousWindow(self):
         return self.previousWindow
 
-    def isWindowIgnored(self, window_title):
-        for pattern in self.ignored_windows:
-            if pattern.search(window_title) is not None:
-                return True
 
-        return False
+class WindowRow():
+
+    def __init__(self, nimbler_window, dpi_scaling_factor):
+        self.name = None
+        self.icon = None
+        self.binding = None
+        self.table = None
+        self.position = None
+        self.highlighted = False
+        self.positions = None
+        self.thumbnail = None
+
+        # Shows what key to press
+        self.binding_label = Gtk.Label()
+        self.binding_label.set_padding(5, 0)
+
+        # Apparently buttons can only have one child, so we need a box
+        # Useful info to be found at http://pygtk.org/pygtk2tutorial/ch-ButtonWidget.html
+        # but keep in mind it's about Gtk+ 2 and also uses differently named Python objects
+        button_box = Gtk.HBox(False, 0)
+        self.image = Gtk.Image()
+        # Empty unless thumbnails are turned on
+        self.thumbnail_image = Gtk.Image()
+        self.button_label = Gtk.Label()
+        self.button_label.set_alignment(0, 0.5) # first attribute is horizontal, second is vertical
+        #button_label.set_max_width_chars(256) # not working, why?
+        # TODO Make configurable?
+        self.button_label.set_ellipsize(Pango.EllipsizeMode.MIDDLE)
+
+        # Pack 'em in
+        button_box.pack_start(self.image, False, False, 3)
+        button_box.pack_start(self.thumbnail_image, False, False, 3)
+        button_box.pack_start(self.button_label, False, False, 3)
+
+        # The all important window button
+        self.button = Gtk.Button()
+        self.button.set_relief(Gtk.ReliefStyle.NONE)
+        self.button.set_size_request((dpi_scaling_factor * 256), -1)
+        #button.set_sensitive(False) needs to be trigged while searching
+        self.button.connect('clicked', nimbler_window.present_window_via_button)
+        # Scrolling over a row scrolls its workspace column
+        self.button.add_events(Gdk.EventMask.SCROLL_MASK)
+        self.button.connect('scroll-event', nimbler_window.scroll_column, self)
+
+        # Add the content to the button
+        self.button.add(button_box)
+
+        # Rows that aren't needed are detached rather than hidden, so once will do
+        self.binding_label.show()
+        self.button.show_all()
+
+    def update(self, name, icon, binding, scale=1):
+        if name != self.name:
+            self.button_label.set_text(name)
+            self.name = name
+            self.positions = None
+
+        if icon is not self.icon:
+            if icon is not None and scale != 1:
+                # Drawn at the monitor's scale rather than blown up
+                self.image.set_from_surface(Gdk.cairo_surface_create_from_pixbuf(icon, scale, None))
+            else:
+                self.image.set_from_pixbuf(icon)
+            self.icon = icon
 
-    def isWindowAlwaysShown(self, window_title):
-        for pattern in self.always_show_windows:
-            if pattern.search(window_title) is not None:
-                return True
+        if binding != self.binding:
+            self.binding_label.set_markup('<b>' + escape(binding) + '</b>')
+            self.button.set_name(binding)
+            self.binding = binding
 
-        return False
+    def set_thumbnail(self, thumbnail):
+        if thumbnail is self.thumbnail:
+            return
+
+        if thumbnail is None:
+            self.thumbnail_image.clear()
+        else:
+            self.thumbnail_image.set_from_pixbuf(thumbnail)
+        self.thumbnail = thumbnail
+
+    def set_positions(self, positions):
+        if positions == self.positions:
+            return
+
+        # Make the matched characters stand out
+        if positions:
+            matched = set(positions)
+            markup = []
+            for i in range(len(self.name)):
+                if i in matched:
+                    markup.append('<b>' + escape(self.name[i]) + '</b>')
+                else:
+                    markup.append(escape(self.name[i]))
+            self.button_label.set_markup(''.join(markup))
+        else:
+            self.button_label.set_text(self.name)
+        self.positions = positions
+
+    def set_highlighted(self, highlighted):
+        if highlighted == self.highlighted:
+            return
+
+        # The best match is what Return will pick
+        if highlighted:
+            self.button.set_relief(Gtk.ReliefStyle.NORMAL)
+        else:
+            self.button.set_relief(Gtk.ReliefStyle.NONE)
+        self.highlighted = highlighted
+
+    def attach(self, table, column, top):
+        position = (column, top)
+        if self.table is table and self.position == position:
+            return
+
+        self.detach()
+        table.attach(self.binding_label, column, column + 1, top, top + 1)
+        table.attach(self.button, column + 1, column + 2, top, top + 1)
+        self.table = table
+        self.position = position
+
+    def detach(self):
+        if self.table is None:
+            return
+
+        self.table.remove(self.binding_label)
+        self.table.remove(self.button)
+        self.table = None
+        self.position = None
+
+
+class WorkspaceColumn():
+
+    # The workspace button on top of a column and, when there are more
+    # windows than fit, the scrollbar next to it. Only the rows that are
+    # scrolled into view get widgets.
+
+    def __init__(self, nimbler_window, table, index):
+        self.table = table
+        self.index = index
+        self.scrollbar_rows = None
+
+        i_label = index + 1
+        self.button = Gtk.Button(label='Workspace ' + str(i_label))
+        self.button.set_name('F' + str(i_label)) # Name is F1 and up to tie into keyboard event handling
+        # The event handler likes a string
+        self.button.connect('clicked', nimbler_window.activate_workspace_via_button)
+        table.attach(self.button, index * 3, index * 3 + 3, 0, 1)
+
+        self.adjustment = Gtk.Adjustment(0, 0, 0, 1, 1, 0)
+        self.scrolled_handler = self.adjustment.connect('value-changed', nimbler_window.column_scrolled)
+        self.scrollbar = Gtk.Scrollbar.new(Gtk.Orientation.VERTICAL, self.adjustment)
+        self.scrollbar.set_no_show_all(True)
+
+    def set_range(self, count, rows):
+        # Returns the index of the first window to show
+        if not rows or count <= rows:
+            self.attach_scrollbar(None)
+            return 0
+
+        offset = min(int(self.adjustment.get_value()), count - rows)
+        # Don't let our own changes count as scrolling
+        self.adjustment.handler_block(self.scrolled_handler)
+        self.adjustment.configure(offset, 0, count, 1, rows, rows)
+        self.adjustment.handler_unblock(self.scrolled_handler)
+        self.attach_scrollbar(rows)
+
+        return offset
+
+    def attach_scrollbar(self, rows):
+        if rows == self.scrollbar_rows:
+            return
+
+        if self.scrollbar_rows is not None:
+            self.table.remove(self.scrollbar)
+            self.scrollbar.hide()
+        if rows is not None:
+            self.table.attach(self.scrollbar, self.index * 3 + 2, self.index * 3 + 3, 1, rows + 1,
+                0, Gtk.AttachOptions.FILL)
+            self.scrollbar.show()
+        self.scrollbar_rows = rows
+
+    def scroll(self, event):
+        if event.direction == Gdk.ScrollDirection.UP:
+            delta = -1
+        elif event.direction == Gdk.ScrollDirection.DOWN:
+            delta = 1
+        elif event.direction == Gdk.ScrollDirection.SMOOTH:
+            delta = event.get_scroll_deltas()[2]
+        else:
+            return
+
+        # set_value() keeps it within bounds
+        self.adjustment.set_value(self.adjustment.get_value() + delta * 3)
+
+    def destroy(self):
+        self.attach_scrollbar(None)
+        self.button.destroy()
+        self.scrollbar.destroy()
 
 
 class NimblerWindow(Gtk.Window):
 
-    def __init__(self, config):
+    def __init__(self, config, source=None):
         Gtk.Window.__init__(self, title='Nimbler')
 
         # Window is initially hidden
         self.hidden = True
         
         # Set up keybindings
-        self.keybindings = KeyBindings()
-        self.numbering = self.keybindings.numbering
-        self.numbering_keyvals = self.keybindings.get_keyvals_from_unicode()
-        self.function_keys_keyvals = self.keybindings.get_keyvals_from_name()
-        # Set up keypad numbers dictionary
-        self.keypad_numbers = {
-            Gdk.KEY_KP_0: Gdk.KEY_0,
-            Gdk.KEY_KP_1: Gdk.KEY_1,
-            Gdk.KEY_KP_2: Gdk.KEY_2,
-            Gdk.KEY_KP_3: Gdk.KEY_3,
-            Gdk.KEY_KP_4: Gdk.KEY_4,
-            Gdk.KEY_KP_5: Gdk.KEY_5,
-            Gdk.KEY_KP_6: Gdk.KEY_6,
-            Gdk.KEY_KP_7: Gdk.KEY_7,
-            Gdk.KEY_KP_8: Gdk.KEY_8,
-            Gdk.KEY_KP_9: Gdk.KEY_9,
+        self.keybindings = KeyBindings(config.shortcut_characters, config.key_bindings)
+        self.shortcuts = []
+        self.shortcut_numbers = {}
+        self.dispatch = {}
+        # Where we are in a shortcut that's more than one key long
+        self.pending = None
+        self.actions = {
+            'hide': self.popdown,
+            'search': self.show_entry,
+            'activate': self.activate_entry,
+            'close': self.close_entry,
+            'workspace': self.activate_workspace,
+            'window': self.present_window_via_number,
+            'close_window': self.close_window_via_number,
         }
         
         # Set up the frame
         self.frame = Gtk.Frame()
         self.frame.set_shadow_type(1)
         self.add(self.frame)
+
+        # The table and its widgets live as long as the window does and are
+        # brought up to date by populate() every time the popup opens
+        self.table = Gtk.Table(1, 2, False)
+        self.table.set_name('NimblerTable')
+        self.frame.add(self.table)
+        self.workspace_columns = []
+        self.max_rows = config.max_rows
+        self.rows = {}
+        self.spare_rows = []
+        self.populated_generation = None
+        # Windows matching what's been typed, None when not searching
+        self.matches = None
+
+        # Set up the box to enter an app name
+        self.enteredName = Gtk.Entry()
+        self.enteredName.set_no_show_all(True)
+        self.entry_position = None
+
+        # Register enteredName event
+        self.enteredName.connect('changed', self.enteredNameChanged)
         
+        # Updated in place on reloads
+        self.config = config
+
+        # The popup opens on the monitor with the pointer. Icons are kept
+        # for every scale in use and the popup's position for every
+        # monitor, so going back and forth doesn't start over each time.
+        self.icon_caches = self.make_icon_caches(config)
+        self.monitor_layouts = {}
+
+        self.set_wnck_icon_size(config.icon_size)
+
         # Initialize window list
         self.windowList = WindowList(
             config.ignored_windows,
             config.always_show_windows,
             config.ignored_window_types,
-            config.icon_size
+            config.icon_size,
+            source,
+            self.icon_caches,
+            self.make_processes(config),
+            self.make_history(config)
         )
+        # What had been typed when the popup closed, for the history
+        self.query = ''
         # Needed for number of windows as well as making sure it's ready before drawing
-        self.windowList.getLatest()
+        if config.live_window_list:
+            self.windowList.watch()
+        else:
+            self.windowList.getLatest()
+
+        # Captured in the background, the popup never waits for them
+        self.thumbnails = self.make_thumbnail_cache(config)
+
+        # Keep the hidden popup up to date so showing it is all that's left to do
+        self.prewarm_source = None
+        self.prewarmed_generation = None
+        self.prewarming = config.prewarm and config.live_window_list
+        self.windowList.add_listener(self.schedule_prewarm)
+        self.schedule_prewarm()
 
         # Register events
         self.connect("key-press-event", self.keypress)
+        self.connect("draw", self.on_draw)
+        self.connect("focus-in-event", self.on_focus_in)
 
     def populate(self, items):
-        self.window_list = self.windowList.windowList
-        self.window_counter = 0
+        # Bring the existing widgets in line with the window list instead of
+        # building new ones, so only rows that actually changed are touched
+        self.window_list = items
         self.num_workspaces = len(self.window_list)
+        self.window_counter = sum([len(i) for i in self.window_list])
+        max_windows = max([len(i) for i in self.window_list] or [0])
+        if self.max_rows:
+            max_windows = min(max_windows, self.max_rows)
 
-        dpi_scaling_factor = DPIScaling().scaling_factor
-        
+        self.dpi_scaling_factor = DPIScaling().scaling_factor
+
+        # Shortcuts go by display order and stay put while searching
+        self.shortcuts = self.keybindings.get_shortcuts(self.window_counter)
+        self.shortcut_numbers = dict([(shortcut, number) for number, shortcut in enumerate(self.shortcuts)])
+        self.dispatch = self.keybindings.get_dispatch(self.shortcuts, self.num_workspaces)
+
+        # Leave room for the workspace buttons and the entry
+        self.table.resize(max_windows + 2, max(self.num_workspaces * 3, 1))
+
+        # Workspace columns are pooled by index
+        for i in range(len(self.workspace_columns), self.num_workspaces):
+            self.workspace_columns.append(WorkspaceColumn(self, self.table, i))
+
+        for workspace_column in self.workspace_columns[self.num_workspaces:]:
+            workspace_column.destroy()
+        del self.workspace_columns[self.num_workspaces:]
+
+        self.layout_rows()
+
+        # The entry always goes below the last row
+        self.attach_entry(self.table, max_windows + 1, max(self.num_workspaces * 3, 1))
+        self.populated_generation = self.windowList.generation
+
+    def layout_rows(self):
+        # Only the windows that match and are scrolled into view get a row,
+        # and only rows whose window, position or state changed are touched
+        if self.matches is None:
+            matched = None
+            best = None
+        else:
+            matched = dict([(i.window, i.positions) for i in self.matches])
+            best = self.matches[0].window if self.matches else None
+
+        # Window rows are pooled by window
+        rows = {}
+        number = 0
         for i in range(0, self.num_workspaces):
-        #for i in range(0, self.workspaces):
-            #print('window_list[i] '+str(window_list[i]))
-            i_label = i + 1
-            i_column_left = i * 2
-            i_column_right = i_column_left + 2
-            i_binding_right = i_column_left + 1
-            
-            workspace_button = Gtk.Button(label='Workspace ' + str(i_label))
-            workspace_button.set_name('F' + str(i_label)) # Name is F1 and up to tie into keyboard event handling
-            # The event handler likes a string
-            workspace_button.connect('clicked', self.activate_workspace_via_button)
-            
-            self.table.attach(workspace_button, i_column_left, i_column_right, 0, 1)
-            
-            #for j in range(0, len(window_list[i])):
-            for j in range(0, len(self.window_list[i])):
-                j4table_left = j + 1
-                j4table_right = j4table_left + 1
-                name = self.window_list[i][j]['name']
-                icon = self.window_list[i][j]['icon']
-                binding = self.numbering[self.window_counter]
-                
-                # Shows what key to press
-                binding_label = Gtk.Label()
-                binding_label.set_padding(5, 0)
-                if self.window_counter < len(self.numbering):
-                    binding_label.set_markup('<b>' + escape(binding) + '</b>')
-                self.table.attach(binding_label, i_column_left, i_binding_right, j4table_left, j4table_right)
-                
-                # Apparently buttons can only have one child, so we need a box
-                # Useful info to be found at http://pygtk.org/pygtk2tutorial/ch-ButtonWidget.html
-                # but keep in mind it's about Gtk+ 2 and also uses differently named Python objects
-                button_box = Gtk.HBox(False, 0)
-                image = Gtk.Image.new_from_pixbuf(icon)
-                button_label = Gtk.Label(name)
-                button_label.set_alignment(0, 0.5) # first attribute is horizontal, second is vertical
-                #button_label.set_max_width_chars(256) # not working, why?
-                # TODO Make configurable?
-                button_label.set_ellipsize(Pango.EllipsizeMode.MIDDLE)
-                
-                # Pack 'em in
-                button_box.pack_start(image, False, False, 3)
-                button_box.pack_start(button_label, False, False, 3)
-                
-                # The all important window button
-                button = Gtk.Button()
-                button.set_relief(Gtk.ReliefStyle.NONE)
-                button.set_size_request((dpi_scaling_factor * 256), -1)
-                button.set_name(binding)
-                #button.set_sensitive(False) needs to be trigged while searching
-                button.connect('clicked', self.present_window_via_button)
-                
-                # Add the content to the button
-                button.add(button_box)
-                self.table.attach(button, i_binding_right, i_column_right, j4table_left, j4table_right)
-                
-                # Up the overall counter
-                self.window_counter += 1
-    
-    def activate_workspace(self, label):
-        # Ignore everything in the supplied string but the numbers
-        workspace = re.sub('[^0-9]', '', label)
-        workspace = int(workspace) - 1
-        
-        self.toggle()
-        self.windowList.workspaces[workspace].activate(self.getXTime())
+            shown = []
+            for entry in self.window_list[i]:
+                if matched is None or entry.window in matched:
+                    shown.append((number, entry))
+                number += 1
+
+            offset = self.workspace_columns[i].set_range(len(shown), self.max_rows)
+            if self.max_rows:
+                shown = shown[offset:offset + self.max_rows]
+
+            for j in range(0, len(shown)):
+                window_number, entry = shown[j]
+                window = entry.window
+
+                row = self.rows.pop(window, None)
+                if row is None:
+                    if self.spare_rows:
+                        row = self.spare_rows.pop()
+                    else:
+                        row = WindowRow(self, self.dpi_scaling_factor)
+                rows[window] = row
+
+                row.update(entry.name, entry.icon, self.shortcuts[window_number], self.icon_caches.scale)
+                row.attach(self.table, i * 3, j + 1)
+                row.set_highlighted(window is best)
+                row.set_positions(matched[window] if matched is not None else None)
+                if self.thumbnails is not None:
+                    row.set_thumbnail(self.thumbnails.get(window))
+
+        # Whatever is left is filtered out, scrolled away or gone; keep it for later
+        for row in self.rows.values():
+            row.detach()
+            self.spare_rows.append(row)
+        self.rows = rows
+
+        # Missing thumbnails show up as they're captured
+        if self.thumbnails is not None:
+            self.thumbnails.request(rows)
+
+    def make_thumbnail_cache(self, config):
+        if not config.thumbnails:
+            return None
+
+        width = int(round(config.thumbnail_width * DPIScaling().scaling_factor))
+        return ThumbnailCache(self.windowList.source, width, config.thumbnail_cache_size * 1024, self.on_thumbnail)
+
+    def on_thumbnail(self, window, thumbnail):
+        row = self.rows.get(window)
+        if row is not None:
+            row.set_thumbnail(thumbnail)
+
+    def column_scrolled(self, adjustment):
+        self.layout_rows()
+
+    def scroll_column(self, button, event, row):
+        if row.position is not None:
+            self.workspace_columns[row.position[0] // 3].scroll(event)
+
+        return True
+
+    def make_processes(self, config):
+        if not config.search_processes:
+            return None
+
+        return ProcessInfo()
+
+    def make_history(self, config):
+        if not config.activation_history:
+            return None
+
+        return ActivationHistory(size=config.activation_history_size)
+
+    def set_wnck_icon_size(self, icon_size):
+        # Have Wnck fetch icons at about the right size to begin with, or
+        # back to its own default, in case a reload changed it
+        if icon_size in IconCache.SIZES:
+            Wnck.set_default_icon_size(IconCache.SIZES['default'])
+        elif icon_size:
+            Wnck.set_default_icon_size(icon_size)
+
+    def make_icon_cache(self, config, scale=1):
+        return IconCache(config.icon_size, DPIScaling().scaling_factor * scale, config.icon_cache_size * 1024)
+
+    def make_icon_caches(self, config, scale=1):
+        return ScaledIconCaches(lambda scale: self.make_icon_cache(config, scale), scale)
+
+    def set_icon_scale(self, scale):
+        if scale == self.icon_caches.scale:
+            return
+
+        self.icon_caches.set_scale(scale)
+        # Brings the windows' icons in line with the scale
+        self.windowList.set_icon_cache(self.icon_caches)
+
+    def get_pointer_monitor(self):
+        latency.count('x_round_trips')
+        display = Gdk.Display.get_default()
+        seat = display.get_default_seat()
+        if seat is None or seat.get_pointer() is None:
+            return None
+
+        screen, x, y = seat.get_pointer().get_position()
+        return display.get_monitor_at_point(x, y)
+
+    def place(self, monitor):
+        # Centered on the monitor. The contents have to be shown by now to
+        # have a size, and GTK keeps that until something in there changes.
+        if monitor is None:
+            return
+
+        minimum, natural = self.get_preferred_size()
+        area = monitor.get_workarea()
+        key = (area.x, area.y, area.width, area.height)
+        layout = self.monitor_layouts.get(key)
+        if layout is None or layout[0] != (natural.width, natural.height):
+            position = (
+                area.x + max(area.width - natural.width, 0) // 2,
+                area.y + max(area.height - natural.height, 0) // 2,
+            )
+            layout = ((natural.width, natural.height), position)
+            self.monitor_layouts[key] = layout
+
+        self.move(*layout[1])
+
+    def apply_config(self, config, changed):
+        # Only redo what the changed options affect, the rest stays warm
+        if changed.keys() & {'ignored_windows', 'always_show_windows', 'ignored_window_types'}:
+            self.windowList.set_rules(config.ignored_windows, config.always_show_windows, config.ignored_window_types)
+
+        if 'icon_size' in changed:
+            self.set_wnck_icon_size(config.icon_size)
+
+        if changed.keys() & {'icon_size', 'icon_cache_size'}:
+            self.icon_caches = self.make_icon_caches(config, self.icon_caches.scale)
+            self.windowList.set_icon_cache(self.icon_caches)
+            self.monitor_layouts = {}
+
+        if 'search_processes' in changed:
+            if self.windowList.processes is not None:
+                self.windowList.processes.close()
+            self.windowList.set_processes(self.make_processes(config))
+
+        if changed.keys() & {'activation_history', 'activation_history_size'}:
+            self.windowList.history = self.make_history(config)
+
+        if 'live_window_list' in changed:
+            if config.live_window_list:
+                self.windowList.watch()
+            else:
+                self.windowList.unwatch()
+                self.windowList.getLatest()
+
+        if 'max_rows' in changed:
+            self.max_rows = config.max_rows
+            # Nothing changed as far as the window list is concerned
+            self.populated_generation = None
+
+        if changed.keys() & {'thumbnails', 'thumbnail_width', 'thumbnail_cache_size'}:
+            if self.thumbnails is not None:
+                self.thumbnails.close()
+            self.thumbnails = self.make_thumbnail_cache(config)
+            if self.thumbnails is not None and not self.hidden:
+                self.thumbnails.pause()
+            for row in list(self.rows.values()) + self.spare_rows:
+                row.set_thumbnail(None)
+            self.populated_generation = None
+
+        if changed.keys() & {'shortcut_characters', 'key_bindings'}:
+            self.keybindings = KeyBindings(config.shortcut_characters, config.key_bindings)
+            self.populated_generation = None
+
+        self.prewarming = config.prewarm and config.live_window_list
+        self.schedule_prewarm()
+
+    def schedule_prewarm(self):
+        if not self.prewarming:
+            return
+        if self.hidden and self.prewarm_source is None:
+            self.prewarm_source = GLib.idle_add(self.prewarm, priority=GLib.PRIORITY_LOW)
+
+    def prewarm(self):
+        self.prewarm_source = None
+        if not self.hidden:
+            return False
+
+        self.windowList.refresh()
+        if self.windowList.generation != self.populated_generation:
+            self.populate(self.windowList.get())
+
+        # Before it's needed for the first search
+        if self.windowList.history is not None:
+            self.windowList.history.load()
+
+        # Everything but the window itself is shown, and asking for the
+        # window's size does the size negotiation while nobody's looking
+        self.frame.show_all()
+        self.get_preferred_size()
+        self.prewarmed_generation = self.populated_generation
+
+        return False
+
+    def attach_entry(self, table, top, columns):
+        position = (top, columns)
+        if self.entry_position == position:
+            return
+
+        if self.entry_position is not None:
+            table.remove(self.enteredName)
+        table.attach(self.enteredName, 0, columns, top, top + 1)
+        self.entry_position = position
+
+    def activate_workspace(self, workspace, timestamp=None):
+        timestamp = self.get_timestamp(timestamp)
+        self.toggle(timestamp)
+        self.windowList.workspaces[workspace].activate(timestamp)
     
     def activate_workspace_via_button(self, button):
+        # Ignore everything in the name but the numbers
         name = button.get_name()
-        self.activate_workspace(name)
+        self.activate_workspace(int(re.sub('[^0-9]', '', name)) - 1, Gtk.get_current_event_time())
         
     def enteredNameChanged(self, entry):
         text = entry.get_text()
 
         if text:
-            self.windowList.rank(text)
-            self.populate(self.windowList.get())
+            self.matches = self.windowList.rank(text)
+        else:
+            self.windowList.reset_rank()
+            self.matches = None
 
-    def close_window(self, window):
-        window.close(self.getXTime())
+        self.layout_rows()
+
+    def close_window(self, window, timestamp=None):
+        window.close(self.get_timestamp(timestamp))
 
-    def close_window_via_number(self, window_number):
-        self.toggle()
+    def close_window_via_number(self, window_number, timestamp=None):
+        timestamp = self.get_timestamp(timestamp)
+        self.toggle(timestamp)
         self.close_window(
-            self.windowList.window_list_merged[window_number]['window']
+            self.windowList.window_list_merged[window_number].window,
+            timestamp
         )
 
-    def presentWindow(self, window):
+    def presentWindow(self, window, timestamp=None):
+        # Both go out with the same timestamp, one right after the other
+        timestamp = self.get_timestamp(timestamp)
         workspace = window.get_workspace()
         if workspace is not None:
-            workspace.activate(self.getXTime())
+            workspace.activate(timestamp)
 
-        window.activate(self.getXTime())
+        window.activate(timestamp)
+        self.windowList.record_activation(window, self.query)
     
     def present_window_via_button(self, button):
         name = button.get_name()
-        window_number = self.numbering.index(name)
-        self.present_window_via_number(window_number)
+        window_number = self.shortcut_numbers[name]
+        self.present_window_via_number(window_number, Gtk.get_current_event_time())
     
-    def present_window_via_number(self, window_number):
-        self.toggle()
+    def present_window_via_number(self, window_number, timestamp=None):
+        timestamp = self.get_timestamp(timestamp)
+        self.toggle(timestamp)
         self.presentWindow(
-            self.windowList.window_list_merged[window_number]['window']
+            self.windowList.window_list_merged[window_number].window,
+            timestamp
         )
 
-    def presentByShortcut(self, event, keyval):
-        # Workspace shortcuts
-        if keyval in self.function_keys_keyvals[:self.num_workspaces]:
-            self.activate_workspace(
-                self.keybindings.function_keys[self.keybindings.get_keyvals_from_name().index(keyval)]
-            )
-        # Window shortcuts
-        elif keyval in self.numbering_keyvals[:self.window_counter]:
-            if event.get_state() & Gdk.ModifierType.CONTROL_MASK:
-                self.close_window_via_number(self.numbering_keyvals.index(keyval))
-            else:
-                self.present_window_via_number(self.numbering_keyvals.index(keyval))
-
-    def presentHighestRanked(self):
+    def presentHighestRanked(self, timestamp=None):
         highestRanked = self.windowList.getHighestRanked()
         if highestRanked is not None:
-            self.presentWindow(highestRanked['window'])
+            timestamp = self.get_timestamp(timestamp)
+            self.toggle(timestamp)
+            self.presentWindow(highestRanked.window, timestamp)
 
     def presentManual(self, view, path, column):
         indices = path.get_indices()
@@ -394,107 +2832,477 @@ class NimblerWindow(Gtk.Window):
         windows = self.windowList.get()
         if index < len(windows):
             self.toggle()
-            self.presentWindow(windows[index]['window'])
+            self.presentWindow(windows[index].window)
+
+    def show_entry(self, timestamp=None):
+        # Show input, thanks to http://stackoverflow.com/a/4956770
+        self.enteredName.show()
+        self.enteredName.grab_focus()
+
+    def activate_entry(self, timestamp=None):
+        text = self.enteredName.get_text()
+
+        # You might decide just to enter the shortcut after all
+        if text in self.shortcut_numbers:
+            self.present_window_via_number(self.shortcut_numbers[text], timestamp)
+        # Otherwise go with the best match
+        else:
+            self.presentHighestRanked(timestamp)
+
+    def close_entry(self, timestamp=None):
+        text = self.enteredName.get_text()
+
+        if text in self.shortcut_numbers:
+            self.close_window_via_number(self.shortcut_numbers[text], timestamp)
+        else:
+            highestRanked = self.windowList.getHighestRanked()
+            if highestRanked is not None:
+                timestamp = self.get_timestamp(timestamp)
+                self.toggle(timestamp)
+                self.close_window(highestRanked.window, timestamp)
 
     def keypress(self, widget, event):
-        # Support pressing numbers on keypad
-        # If event.keyval is found in the dictionary of keypad numbers it'll change it into a regular number;
-        # otherwise it simply returns event.keyval
-        # Thanks to http://stackoverflow.com/a/103081
-        event.keyval = self.keypad_numbers.get(event.keyval, event.keyval)
-        
-        #selected = self.appListView.get_selection().get_selected()
-        if event.keyval == Gdk.KEY_Escape:
-            self.toggle()
-        if not self.enteredName.has_focus() and self.presentByShortcut(event, event.keyval):
-            return
-        elif event.keyval == Gdk.KEY_colon:
-            # Show input, thanks to http://stackoverflow.com/a/4956770
-            self.enteredName.show()
-            self.enteredName.grab_focus()
-            # Return True so the colon doesn't end up in the Entry box
-            return True
-        # The text input has focus
+        key = (event.keyval, int(event.get_state() & KeyBindings.MODIFIERS))
+
+        if self.enteredName.has_focus():
+            action = self.keybindings.typing_bindings.get(key)
         else:
-            if event.keyval == Gdk.KEY_Return:
-                # TODO do something!
-                text = self.enteredName.get_text()
-
-                # You might decide just to enter the character after all
-                # Needs to be converted to keyval though
-                number = ord(text)
-                keyval = Gdk.unicode_to_keyval(number)
-                if len(text) == 1 and self.presentByShortcut(event, keyval):
-                    return
-        
-    def toggle(self):
+            action = None
+            # The rest of a longer shortcut, or start over
+            if self.pending is not None:
+                action = self.pending.get(key)
+                self.pending = None
+            if action is None:
+                action = self.dispatch.get(key)
+
+            if isinstance(action, dict):
+                self.pending = action
+                return True
+
+        if action is None:
+            return False
+
+        # The key press's own time saves asking the X server for it
+        self.actions[action[0]](*action[1:], timestamp=event.time)
+        return True
+
+    def toggle(self, timestamp=None):
         if self.hidden:
-            self.windowList.refresh()
-            self.max_windows = self.windowList.get_max_windows() #change
-            self.workspaces = len(self.windowList.get()) #bit illogical naming going on here
-            
-            self.table = Gtk.Table(self.max_windows, self.workspaces * 2, False)
-            self.table.set_name('NimblerTable')
-            #self.add(self.table)
-            self.frame.add(self.table)
-            
-            # Set up the box to enter an app name
-            self.enteredName = Gtk.Entry()
-            # Set up event
-            self.enteredName.connect("changed", self.enteredNameChanged)
-            self.table.attach(self.enteredName, 0, self.workspaces*2, self.max_windows+1, self.max_windows+2)
-            self.enteredName.set_no_show_all(True)
-
-            # Register enteredName event
-            self.enteredName.connect('changed', self.enteredNameChanged)
-            
-            # Populate windows
-            self.populate(self.windowList.get())
+            latency.begin('toggle')
+            # The popup would end up in the thumbnails
+            if self.thumbnails is not None:
+                self.thumbnails.pause()
+            monitor = self.get_pointer_monitor()
+            self.set_icon_scale(DPIScaling(monitor).monitor_scale)
+
+            with latency.span('refresh'):
+                self.windowList.refresh()
+
+            # Populate windows, unless nothing changed since the last time
+            if self.windowList.generation != self.populated_generation:
+                with latency.span('populate'):
+                    self.populate(self.windowList.get())
             
             # Set state
             self.hidden = False
-            self.show_all()
-
-            # Clear out the text field
-            #self.enteredName.set_text('')
-            #self.enteredName.grab_focus()
+            with latency.span('show'):
+                if self.prewarmed_generation != self.populated_generation:
+                    self.frame.show_all()
+                self.place(monitor)
+                self.show()
 
             # Show our window with focus
             self.stick()
 
-            time = self.getXTime()
+            self.get_window().focus(self.get_timestamp(timestamp))
 
-            self.get_window().focus(time)
+            # Windows may look different since they were last captured,
+            # they're captured again once the popup is gone
+            if self.thumbnails is not None:
+                self.thumbnails.request(self.rows)
         else:
             self.hidden = True
-            self.table.destroy()
+            self.pending = None
+            # Clear out the text field
+            self.query = self.enteredName.get_text()
+            self.enteredName.set_text('')
+            self.enteredName.hide()
             self.hide()
             self.resize(1,1)
+            if self.thumbnails is not None:
+                self.thumbnails.resume()
+            # Closed before it got that far
+            latency.finish()
+
+            # Catch up with whatever changed while we were open
+            if self.prewarming:
+                self.schedule_prewarm()
 
     def hotkey(self, key, data):
-        self.toggle()
+        if self.hidden:
+            latency.begin('hotkey')
+        with latency.span('hotkey'):
+            self.toggle(load_keybinder().get_current_event_time())
+
+    def on_draw(self, widget, context):
+        latency.mark('first_draw')
+        return False
+
+    def on_focus_in(self, widget, event):
+        latency.mark('focus')
+        return False
+
+    def popup(self, timestamp=None):
+        if self.hidden:
+            self.toggle(timestamp)
+
+    def popdown(self, timestamp=None):
+        if not self.hidden:
+            self.toggle(timestamp)
+
+    def get_timestamp(self, timestamp=None):
+        # Preferably the time of the event that got us here, asking the X
+        # server for the time is a round-trip
+        if not timestamp:
+            timestamp = Gtk.get_current_event_time()
+        if not timestamp:
+            timestamp = self.getXTime()
+
+        return timestamp
 
     def getXTime(self):
+        return get_server_time(self.get_window())
+
+    def list_windows(self, as_json=False):
+        # While the popup is open the list has to stay in the order its
+        # shortcuts refer to; the model is kept up to date anyway
+        if self.hidden:
+            self.windowList.refresh()
+        return format_windows(self.windowList.window_list_merged, as_json)
+
+    def activate_query(self, query):
+        # For --activate, the popup stays where it is, along with its ranking
+        if self.hidden:
+            self.windowList.refresh()
+        return activate_best_match(self.windowList, query, self.get_timestamp())
+
+
+def load_keybinder():
+    # Only the hotkey needs it, so listing windows works without it installed
+    gi.require_version('Keybinder', '3.0')
+    from gi.repository import Keybinder
+    return Keybinder
+
+def get_server_time(window=None):
+    # A round-trip, the root window will do when there's no window of our own yet
+    latency.count('x_round_trips')
+    try:
+        return GdkX11.x11_get_server_time(window or Gdk.get_default_root_window())
+    except:
+        return 0
+
+def format_windows(entries, as_json=False):
+    windows = []
+    for entry in entries:
+        workspace = entry.window.get_workspace()
+        windows.append({
+            'id': entry.window.get_xid(),
+            # Numbered from 1 like the workspace buttons, None on all of them
+            'workspace': workspace.get_number() + 1 if workspace is not None else None,
+            'class_group': entry.class_group,
+            'name': entry.name,
+        })
+
+    if as_json:
+        return json.dumps(windows) + '\n'
+
+    lines = []
+    for window in windows:
+        lines.append('0x%08x\t%s\t%s\t%s\n' % (window['id'], window['workspace'] or '-',
+            window['class_group'] or '', window['name']))
+
+    return ''.join(lines)
+
+def activate_best_match(window_list, query, timestamp):
+    # Returns the window that was activated as listed, nothing if none matched
+    best = window_list.best_match(query)
+    if best is None:
+        return ''
+
+    workspace = best.window.get_workspace()
+    if workspace is not None:
+        workspace.activate(timestamp)
+    best.window.activate(timestamp)
+    window_list.record_activation(best.window, query)
+
+    return format_windows([best])
+
+def query_main(args, config):
+    # --list and --activate without a daemon: the window list, but no popup,
+    # icons or hotkey
+    windows = WindowList(
+        config.ignored_windows,
+        config.always_show_windows,
+        config.ignored_window_types,
+        config.icon_size,
+        None,
+        NoIcons(),
+        None,
+        ActivationHistory(size=config.activation_history_size) if args.activate and config.activation_history else None
+    )
+    windows.refresh()
+
+    if args.list:
+        sys.stdout.write(format_windows(windows.window_list_merged, args.json))
+        return 0
+
+    reply = activate_best_match(windows, args.activate, get_server_time())
+    sys.stdout.write(reply)
+    # Make sure the activation goes out before we do
+    Gdk.Display.get_default().flush()
+
+    return 0 if reply else 1
+
+
+class StartupReport():
+
+    # Where the daemon's own startup time went
+
+    def __init__(self):
+        self.phases = []
+
+        interpreter = self.get_interpreter_time()
+        if interpreter is not None:
+            self.phases.append(('interpreter', interpreter))
+        self.phases.append(('imports', IMPORTED - STARTED))
+        self.last = IMPORTED
+        self.mark('module')
+
+    def get_interpreter_time(self):
+        # From the process being started until this file started running
+        try:
+            with open('/proc/self/stat') as stat:
+                # The fields after the command name, starting with field 3
+                fields = stat.read().rsplit(')', 1)[1].split()
+            process_started = int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+            booted = time.clock_gettime(time.CLOCK_BOOTTIME) - (time.time() - STARTED)
+        except (AttributeError, EnvironmentError, IndexError, ValueError):
+            return None
+
+        return max(booted - process_started, 0)
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def format(self):
+        lines = []
+        for phase, duration in self.phases:
+            lines.append('%-12s %8.1f ms\n' % (phase, duration * 1000))
+        lines.append('%-12s %8.1f ms\n' % ('total', sum([duration for phase, duration in self.phases]) * 1000))
+
+        return ''.join(lines)
+
+
+class ControlSocket():
+
+    # Lets other processes send the daemon a command, one per connection.
+    # That's what --show, --toggle and friends do, but anything that can
+    # write a line to a Unix socket will do, e.g.
+    #   echo toggle | socat - UNIX-CONNECT:$XDG_RUNTIME_DIR/nimbler-1000:0.sock
+
+    # Milliseconds a client gets to send its command, and how long it may be
+    TIMEOUT = 1000
+    MAX_COMMAND = 4096
+
+    def __init__(self, path, handlers, argument_handlers=None):
+        self.path = path
+        self.handlers = handlers
+        self.handlers['ping'] = lambda: 'pong\n'
+        # Commands followed by a space and an argument, like "activate firefox"
+        self.argument_handlers = argument_handlers or {}
+        # Connections still sending their command, to what came in so far
+        # and the sources watching them
+        self.connections = {}
+
+        # Left over from a daemon that didn't get to clean up after itself
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Nobody else gets to connect, not even before the chmod
+        umask = os.umask(0o077)
+        try:
+            self.socket.bind(path)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+        self.socket.listen(5)
+        self.source_id = GLib.io_add_watch(self.socket.fileno(), GLib.PRIORITY_HIGH, GLib.IO_IN, self.on_connection)
+
+    def on_connection(self, fd, condition):
+        try:
+            connection, address = self.socket.accept()
+        except socket.error:
+            return True
+
+        # Read as it comes in, a slow client mustn't hold up the popup
+        connection.setblocking(False)
+        self.connections[connection] = [
+            b'',
+            GLib.io_add_watch(connection.fileno(), GLib.PRIORITY_HIGH,
+                GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.on_data, connection),
+            GLib.timeout_add(self.TIMEOUT, self.on_timeout, connection),
+        ]
+
+        return True
+
+    def on_data(self, fd, condition, connection):
+        state = self.connections[connection]
         try:
-            time = GdkX11.x11_get_server_time(self.get_window())
-        except:
-            time = 0
+            data = connection.recv(1024)
+        except BlockingIOError:
+            return True
+        except socket.error:
+            data = b''
+
+        state[0] += data
+        # Until the end of the line or the end of what's sent
+        if data and not state[0].endswith(b'\n') and len(state[0]) < self.MAX_COMMAND:
+            return True
+
+        command = state[0]
+        self.forget(connection)
+        try:
+            reply = self.run(command.decode('utf-8', 'replace').strip())
+            # Sending can't take forever either
+            connection.settimeout(self.TIMEOUT / 1000.0)
+            connection.sendall(reply.encode('utf-8'))
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+        return False
+
+    def on_timeout(self, connection):
+        # Too slow, it doesn't get an answer
+        self.forget(connection)
+        connection.close()
+
+        return False
+
+    def forget(self, connection):
+        data, watch_id, timeout_id = self.connections.pop(connection)
+        GLib.source_remove(watch_id)
+        GLib.source_remove(timeout_id)
+
+    def run(self, command):
+        name, separator, argument = command.partition(' ')
+
+        if name in self.argument_handlers and argument:
+            return self.argument_handlers[name](argument) or ''
+        elif command in self.handlers:
+            return self.handlers[command]() or ''
+        else:
+            return 'Unknown command: %s\n' % command
+
+    def close(self):
+        for connection in list(self.connections):
+            self.forget(connection)
+            connection.close()
+        GLib.source_remove(self.source_id)
+        self.socket.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ConfigWatcher():
+
+    # Calls back when any of the configuration files is created, changed or
+    # removed. Editors tend to save in several steps, so it waits for things
+    # to settle down first.
+
+    DELAY = 250
+
+    def __init__(self, paths, callback):
+        self.callback = callback
+        self.timeout_id = None
+        self.monitors = []
+        for path in paths:
+            # Also works for files that don't exist yet
+            monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.NONE, None)
+            monitor.connect('changed', self.on_changed)
+            self.monitors.append(monitor)
+
+    def on_changed(self, monitor, changed_file, other_file, event_type):
+        if event_type == Gio.FileMonitorEvent.ATTRIBUTE_CHANGED:
+            return
+
+        if self.timeout_id is not None:
+            GLib.source_remove(self.timeout_id)
+        self.timeout_id = GLib.timeout_add(self.DELAY, self.on_timeout)
+
+    def on_timeout(self):
+        self.timeout_id = None
+        self.callback()
+        return False
 
-        return time
+    def close(self):
+        for monitor in self.monitors:
+            monitor.cancel()
+        if self.timeout_id is not None:
+            GLib.source_remove(self.timeout_id)
 
 
 class Config:
 
-    def __init__(self):
+    # Everything loadOptions() sets, what reload() compares
+    OPTIONS = (
+        'hotkey', 'ignored_windows', 'always_show_windows', 'ignored_window_types', 'icon_size',
+        'live_window_list', 'max_rows', 'icon_cache_size', 'prewarm', 'shortcut_characters', 'key_bindings', 'search_processes',
+        'activation_history', 'activation_history_size',
+        'thumbnails', 'thumbnail_width', 'thumbnail_cache_size'
+    )
+
+    def __init__(self, paths=None):
+        if paths is None:
+            paths = [
+                os.path.expanduser('~/.config/nimbler.conf'),
+                os.path.expanduser('~/nimbler.conf'),
+                os.path.expanduser('~/.nimbler.conf')
+            ]
+
+        self.paths = paths
         self.config = configparser.ConfigParser()
-        self.config.read([
-            os.path.expanduser('~/.config/nimbler.conf'),
-            os.path.expanduser('~/nimbler.conf'),
-            os.path.expanduser('~/.nimbler.conf')
-        ])
+        self.config.read(paths)
 
         self.loadOptions()
 
+    def getOptions(self):
+        return dict([(option, getattr(self, option)) for option in self.OPTIONS])
+
+    def reload(self):
+        # Returns the options that changed along with their previous values
+        previous = self.getOptions()
+        try:
+            config = Config(self.paths)
+            # Just to be sure the rules compile before anything gets replaced
+            WindowRules(config.ignored_windows, config.always_show_windows, config.ignored_window_types)
+            KeyBindings(config.shortcut_characters, config.key_bindings)
+        except (configparser.Error, re.error, ValueError) as error:
+            print("Could not reload the configuration:", error)
+            return {}
+
+        # Already parsed, no need to do it all again
+        self.config = config.config
+        for option in self.OPTIONS:
+            setattr(self, option, getattr(config, option))
+        current = self.getOptions()
+
+        return dict([(option, previous[option]) for option in self.OPTIONS if current[option] != previous[option]])
+
     def loadOptions(self):
         self.hotkey = self.getOption('hotkey', 'F10')
         self.ignored_windows = self.prepareIgnoredWindows(
@@ -505,6 +3313,22 @@ class Config:
         )
         self.ignored_window_types = self.getIgnoredWindowTypes()
         self.icon_size = self.get_icon_size(self.getOption('icon_size', 'default'))
+        self.live_window_list = bool(int(self.getOption('live_window_list', 1)))
+        # Per workspace, 0 for no limit
+        self.max_rows = int(self.getOption('max_rows', 30))
+        # In KiB
+        self.icon_cache_size = int(self.getOption('icon_cache_size', 4096))
+        self.prewarm = bool(int(self.getOption('prewarm', 1)))
+        # None for the default
+        self.shortcut_characters = self.getOption('shortcut_characters', None)
+        self.key_bindings = self.splitLines(self.getOption('key_bindings', []))
+        self.search_processes = bool(int(self.getOption('search_processes', 1)))
+        self.activation_history = bool(int(self.getOption('activation_history', 1)))
+        self.activation_history_size = int(self.getOption('activation_history_size', 1000))
+        self.thumbnails = bool(int(self.getOption('thumbnails', 0)))
+        self.thumbnail_width = int(self.getOption('thumbnail_width', 160))
+        # In KiB
+        self.thumbnail_cache_size = int(self.getOption('thumbnail_cache_size', 8192))
 
     def getOption(self, option_name, default_value):
         if self.config.has_option('DEFAULT', option_name):
@@ -513,21 +3337,17 @@ class Config:
             return default_value
 
     def prepareIgnoredWindows(self, ignored_windows):
-        return self.splitAndCompileWindowRegexes(ignored_windows)
+        return self.splitLines(ignored_windows)
 
     def prepareAlwaysShowWindows(self, always_show_windows):
-        return self.splitAndCompileWindowRegexes(always_show_windows)
-
-    def splitAndCompileWindowRegexes(self, windows):
-        # Turn window str into a list
-        if type(windows) is str:
-            windows = filter(None, windows.split("\n"))
+        return self.splitLines(always_show_windows)
 
-        # Now, turn each of the window names into a regex pattern
-        for i in range(0, len(windows)):
-            windows[i] = re.compile(windows[i])
+    def splitLines(self, lines):
+        # Turn a multi-line str into a list
+        if type(lines) is str:
+            lines = list(filter(None, lines.split("\n")))
 
-        return windows
+        return lines
 
     def getIgnoredWindowTypes(self):
         window_types = {
@@ -554,29 +3374,143 @@ class Config:
         if icon_size == 'default' or icon_size == 'mini':
             return icon_size
         elif icon_size.isdigit():
-            icon_size = int(icon_size)
-            Wnck.set_default_icon_size(icon_size)
-            return 'default'
-
-# Catch SIGINT signal
-signal.signal(signal.SIGINT, signal.SIG_DFL)
-
-# Load the configuration with defaults
-config = Config()
-
-# Create the window and set attributes
-win = NimblerWindow(config)
-win.connect("delete-event", Gtk.main_quit)
-win.set_position(Gtk.WindowPosition.CENTER)
-win.set_keep_above(True)
-win.set_skip_taskbar_hint(True)
-win.set_decorated(False)
-
-# Set the hotkey
-Keybinder.init()
-if not Keybinder.bind(config.hotkey, win.hotkey, None):
-    print("Could not bind the hotkey:", config.hotkey)
-    exit()
-
-# The main loop
-Gtk.main()
+            return int(icon_size)
+
+def main():
+    report = StartupReport()
+
+    parser = argparse.ArgumentParser(description='GTK-based window switcher.')
+    parser.add_argument('--daemon', action='store_true',
+        help='listen for commands like --toggle from other processes')
+    parser.add_argument('--no-hotkey', action='store_true',
+        help="don't bind the hotkey, e.g. because the window manager runs --toggle instead")
+    for option in sorted(CLIENT_COMMANDS):
+        parser.add_argument(option, dest='command', action='store_const', const=CLIENT_COMMANDS[option],
+            help='send "%s" to the running daemon' % CLIENT_COMMANDS[option])
+    parser.add_argument('--record-trace', metavar='PATH',
+        help='record window events to PATH for ReplayWindowSource')
+    parser.add_argument('--latency-log', metavar='PATH',
+        help='append the timings of every popup to PATH as JSON lines, - for stderr')
+    parser.add_argument('--profile', metavar='DIR',
+        help='write a cProfile dump to DIR for every popup')
+    parser.add_argument('--profile-memory', action='store_true',
+        help='with --profile, also write a tracemalloc snapshot for every popup')
+    parser.add_argument('--list', action='store_true',
+        help='print the windows Nimbler would show, one per line, and exit')
+    parser.add_argument('--json', action='store_true',
+        help='with --list, print the windows as JSON instead')
+    parser.add_argument('--activate', metavar='QUERY',
+        help='switch to the window that best matches QUERY and exit')
+    args = parser.parse_args()
+
+    if args.command:
+        return client_main(args.command)
+
+    if args.list or args.activate is not None:
+        # The daemon has the window list at hand, otherwise make one
+        if args.list:
+            command = 'list-json' if args.json else 'list'
+        else:
+            command = get_activate_command(args.activate)
+            if command is None:
+                parser.error('--activate needs something to look for')
+        # Unless it was already asked before the imports
+        if command != early_query_command:
+            status = query_client_main(command)
+            if status is not None:
+                return status
+
+        return query_main(args, Config())
+
+    if args.daemon:
+        try:
+            running = send_command('ping') is not None
+        except socket.timeout:
+            print('Nimbler is already running, but not responding')
+            return 1
+        if running:
+            print('Nimbler is already running')
+            return 1
+
+    # Catch SIGINT signal
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    # Load the configuration with defaults
+    config = Config()
+    report.mark('config')
+
+    # Create the window and set attributes
+    win = NimblerWindow(config)
+    win.connect("delete-event", Gtk.main_quit)
+    win.set_position(Gtk.WindowPosition.CENTER)
+    win.set_keep_above(True)
+    win.set_skip_taskbar_hint(True)
+    win.set_decorated(False)
+    report.mark('window list')
+
+    if args.record_trace:
+        # Its signal handlers keep it around
+        TraceRecorder(win.windowList.source, args.record_trace)
+
+    if args.latency_log == '-':
+        latency.log = sys.stderr
+    elif args.latency_log:
+        latency.log = open(args.latency_log, 'a')
+    if args.profile:
+        latency.profile_dir = args.profile
+        if args.profile_memory:
+            latency.profile_memory = True
+            import tracemalloc
+            tracemalloc.start()
+
+    # Set the hotkey
+    if not args.no_hotkey:
+        Keybinder = load_keybinder()
+        Keybinder.init()
+        if not Keybinder.bind(config.hotkey, win.hotkey, None):
+            print("Could not bind the hotkey:", config.hotkey)
+            # Still reachable through the socket
+            if not args.daemon:
+                return 1
+        report.mark('hotkey')
+
+    def reload_config():
+        changed = config.reload()
+        if not changed:
+            return
+
+        win.apply_config(config, changed)
+        if 'hotkey' in changed and not args.no_hotkey:
+            Keybinder = load_keybinder()
+            Keybinder.unbind(changed['hotkey'])
+            if not Keybinder.bind(config.hotkey, win.hotkey, None):
+                print("Could not bind the hotkey:", config.hotkey)
+
+    # Pick up changes to the configuration without restarting
+    watcher = ConfigWatcher(config.paths, reload_config)
+
+    control = None
+    if args.daemon:
+        control = ControlSocket(get_socket_path(), {
+            'show': win.popup,
+            'hide': win.popdown,
+            'toggle': win.toggle,
+            'quit': Gtk.main_quit,
+            'startup': report.format,
+            'stats': latency.format,
+            'list': win.list_windows,
+            'list-json': lambda: win.list_windows(True),
+        }, {
+            'activate': win.activate_query,
+        })
+        report.mark('socket')
+
+    # The main loop
+    Gtk.main()
+
+    watcher.close()
+    if control is not None:
+        control.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
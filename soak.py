@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# Soak test for the popup: opens it, searches and closes it again thousands
+# of times against fake windows, and checks that memory, GObject wrappers,
+# widgets and signal handlers stop growing once everything has warmed up.
+# A daemon runs for weeks, so anything that grows per popup is a leak.
+#
+# It needs a display, but Xvfb will do:
+#
+#   xvfb-run -a python3 soak.py --cycles 5000
+#
+# Exits with 1 if anything kept growing.
+#
+# GObject instances are only counted by GLib built with debugging enabled,
+# distribution builds usually aren't; without it only the Python wrappers of
+# GObjects are counted, which misses objects that never got a wrapper.
+
+import argparse
+import gc
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Read when GObject's type system starts, so before anything imports gi
+os.environ['GOBJECT_DEBUG'] = ','.join(filter(None, [os.environ.get('GOBJECT_DEBUG'), 'instance-count']))
+
+import nimbler
+from nimbler import Gdk, Gtk
+from gi.repository import GObject
+# The same fake windows as the benchmarks
+from benchmark import make_source, open_window
+
+
+QUERIES = ['term', 'fire', 'nimb', 'vi', 'x', 'résumé', 'zzzz']
+
+
+def run_main_loop():
+    # Drawing, idle callbacks and whatever else is waiting
+    while Gtk.events_pending():
+        Gtk.main_iteration_do(False)
+
+
+def get_rss():
+    # In KiB
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+
+
+def count_gobject_wrappers():
+    # Python wrappers that are still around
+    return len([obj for obj in gc.get_objects() if isinstance(obj, GObject.Object)])
+
+
+def count_gobjects(gtype=None):
+    # Every instance of every GObject type, whether Python knows about it or
+    # not. Always 0 unless GLib keeps count, see the top of the file.
+    if gtype is None:
+        gtype = GObject.Object.__gtype__
+    count = GObject.type_get_instance_count(gtype)
+    for child in GObject.type_children(gtype):
+        count += count_gobjects(child)
+
+    return count
+
+
+def count_widgets(widget):
+    # Everything in the popup, whether it's shown or not
+    count = 1
+    if isinstance(widget, Gtk.Container):
+        children = []
+        widget.forall(children.append)
+        for child in children:
+            count += count_widgets(child)
+
+    return count
+
+
+def count_gtk_handlers(obj, signal_name):
+    # GObject has no way of counting them, so find them one by one,
+    # blocking each so the next search finds the next one
+    signal_id = GObject.signal_lookup(signal_name, type(obj))
+    mask = GObject.SignalMatchType.ID | GObject.SignalMatchType.UNBLOCKED
+    found = []
+    while True:
+        handler_id = GObject.signal_handler_find(obj, mask, signal_id, 0, None, None, None)
+        if not handler_id:
+            break
+        obj.handler_block(handler_id)
+        found.append(handler_id)
+
+    for handler_id in found:
+        obj.handler_unblock(handler_id)
+
+    return len(found)
+
+
+def count_replay_handlers(source):
+    # What WindowList and friends connected to the fake windows
+    return len(source.handlers) + sum([len(window.handlers) for window in source.windows])
+
+
+def measure(win, source, counting):
+    gc.collect()
+    rows = list(win.rows.values()) + win.spare_rows
+
+    sample = {
+        'rss_kib': get_rss(),
+        'gobject_wrappers': count_gobject_wrappers(),
+        'widgets': count_widgets(win),
+        'entry_handlers': count_gtk_handlers(win.enteredName, 'changed'),
+        'window_handlers': sum([count_gtk_handlers(win, name)
+            for name in ('key-press-event', 'draw', 'focus-in-event')]),
+        'row_handlers': sum([count_gtk_handlers(row.button, 'clicked') for row in rows]),
+        'replay_handlers': count_replay_handlers(source),
+        'rows': len(rows),
+    }
+    if counting:
+        sample['gobjects'] = count_gobjects()
+
+    return sample
+
+
+def cycle(win, source, number, next_id):
+    win.popup()
+    run_main_loop()
+
+    # Type a query one character at a time, then delete it again
+    query = QUERIES[number % len(QUERIES)]
+    for i in range(1, len(query) + 1):
+        win.enteredName.set_text(query[:i])
+        run_main_loop()
+    win.enteredName.set_text('')
+
+    # The windows change while the popup is open, but there are always as many
+    window = random.choice(source.windows)
+    source.rename_window(window, window.get_name()[::-1])
+    if number % 10 == 0:
+        source.close_window(random.choice(source.windows[1:]))
+        open_window(source, next_id, pids=True)
+        next_id += 1
+    run_main_loop()
+
+    # Close it one way or another
+    if number % 3 == 0:
+        win.enteredName.set_text(query)
+        win.presentHighestRanked()
+    win.popdown()
+    run_main_loop()
+
+    return next_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Open and close the popup many times and check for leaks.')
+    parser.add_argument('--cycles', type=int, default=2000, help='number of popups')
+    parser.add_argument('--windows', type=int, default=200, help='number of fake windows')
+    parser.add_argument('--workspaces', type=int, default=4, help='number of fake workspaces')
+    parser.add_argument('--sample', type=int, default=100, help='measure every this many popups')
+    parser.add_argument('--warmup', type=int, default=200, help='popups before growth starts to count')
+    parser.add_argument('--max-rss-growth', type=int, default=4096,
+        help='KiB the resident set may grow by after warming up')
+    parser.add_argument('--json', action='store_true', help='print measurements as JSON lines')
+    args = parser.parse_args()
+
+    if Gdk.Display.get_default() is None:
+        print('No display, try xvfb-run', file=sys.stderr)
+        return 2
+
+    # Defaults only, plus the optional parts that hold on to things
+    config = nimbler.Config([])
+    config.live_window_list = True
+    config.thumbnails = True
+    config.search_processes = False
+    # Don't write to the history of whoever runs this
+    config.activation_history = False
+
+    random.seed(args.windows)
+    source = make_source(args.windows, args.workspaces, pids=True)
+    win = nimbler.NimblerWindow(config, source)
+    run_main_loop()
+
+    # The popup alone is hundreds of them, so none means nobody's counting
+    counting = count_gobjects() > 0
+    if not counting:
+        print('GLib does not count GObject instances, counting Python wrappers only', file=sys.stderr)
+
+    samples = []
+    next_id = args.windows
+    start = time.perf_counter()
+    for number in range(1, args.cycles + 1):
+        next_id = cycle(win, source, number, next_id)
+
+        if number % args.sample == 0 or number == args.cycles:
+            sample = measure(win, source, counting)
+            sample['cycle'] = number
+            samples.append(sample)
+            if args.json:
+                print(json.dumps(sample))
+            else:
+                print('cycle %6d: %s' % (number, ', '.join(['%s %d' % (key, value)
+                    for key, value in sorted(sample.items()) if key != 'cycle'])))
+
+    elapsed = time.perf_counter() - start
+    warm = [sample for sample in samples if sample['cycle'] >= args.warmup] or samples[-1:]
+    first, last = warm[0], warm[-1]
+    cycles = max(last['cycle'] - first['cycle'], 1)
+
+    failures = []
+    for key in sorted(first):
+        if key == 'cycle':
+            continue
+        growth = last[key] - first[key]
+        if not args.json:
+            print('%-16s %10d -> %10d, %+.3f per popup' % (key, first[key], last[key], growth / float(cycles)))
+        if key == 'rss_kib':
+            if growth > args.max_rss_growth:
+                failures.append('%s grew by %d KiB' % (key, growth))
+        # Everything else should be flat once the pools are full
+        elif growth > 0:
+            failures.append('%s grew by %d' % (key, growth))
+
+    if not args.json:
+        print('%d popups in %.1f s, %.2f ms each' % (args.cycles, elapsed, elapsed * 1000 / args.cycles))
+
+    win.windowList.unwatch()
+    win.destroy()
+
+    for failure in failures:
+        print('FAIL: ' + failure, file=sys.stderr)
+
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())